@@ -15,12 +15,13 @@ liste_equipements = [
                 ['C201','C301','C302','C303','C304','C305'],['D201'],['E107','E108','E109'],['F303'],['F307'],['F313']
             ]
 
-def equipements_prep(liste_iris):
+def equipements_prep(liste_iris, amenities=None):
     """
     Aggregate the number of equipment for selected categories at the IRIS level.
 
     Args:
         liste_iris (list): list of IRIS to include in the aggregation.
+        amenities (pd.DataFrame, optional): the amenities table, if already loaded (see read_equi).
 
     Returns:
         pd.DataFrame: dataframe containing the aggregated number of equipment for the selected 
@@ -33,7 +34,8 @@ def equipements_prep(liste_iris):
     print("Adding amenities...")
     
     # Read amenities file
-    amenities = read_equi()
+    if amenities is None:
+        amenities = read_equi()
     
     # Filter the amenities dataframe to only include IRIS of interest
     amenities = amenities[amenities['DCIRIS'].isin(liste_iris)]
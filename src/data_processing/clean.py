@@ -3,15 +3,70 @@ This module provides functions for cleaning and preprocessing real estate and ed
 
 Functions:
 
+    multivente_mask(data, types_bien, single_disposition=True):
+        Computes in a single grouped pass the mask of the rows kept by the multivente cleaning.
     clean_type(data, type_bien): 
         Cleans data by removing all properties of a given type (Appartement, Maison, etc.) 
     where the same property has been counted multiple times.
-    clean_multivente(data): 
+    clean_multivente(data, drop_duplicates=True): 
         Cleans a given dataset by removing duplicates and mutations with multiple disposition 
     IDs, filtering for 'Vente' transactions, and keeping only one row for each property type if there
     are multiple rows with the same mutation ID.
 """
+import numpy as np
 import pandas as pd
+from utils.common import drop_duplicate_rows, get_positions
+
+
+TYPES_CLEAN = ['Appartement', 'Maison']
+
+
+def multivente_mask(data, types_bien, single_disposition=True):
+    """
+    Compute in a single grouped pass the mask of the rows kept by the multivente cleaning.
+
+    The mutations (id_mutation, date_mutation) are encoded as integers, and every group 
+    statistic is counted with np.bincount on those codes:
+        - the number of distinct disposition numbers of each mutation,
+        - the number of rows and of distinct disposition numbers of each property type 
+        within each mutation.
+
+    Args:
+        data: pandas DataFrame containing geographical data.
+        types_bien: list of the property types to keep.
+        single_disposition: whether to drop the mutations with multiple disposition IDs.
+
+    Returns:
+        A tuple of two numpy arrays: the boolean mask of the rows to keep, and the position 
+        of the type of each row in 'types_bien' (-1 for other types).
+    """
+    mutation = data.groupby(['id_mutation', 'date_mutation'], sort=False, dropna=False)\
+                .ngroup().to_numpy()
+    n_mutations = mutation.max() + 1 if len(mutation) else 0
+    type_code = get_positions(pd.Index(types_bien), data['type_local'])
+    is_type = type_code >= 0
+    disposition, dispositions = pd.factorize(data['numero_disposition'])
+    has_disposition = disposition >= 0
+    n_dispositions = max(len(dispositions), 1)
+
+    # Number of rows and of distinct disposition numbers per (mutation, type)
+    group = mutation * len(types_bien) + type_code
+    size_type = np.bincount(group[is_type], minlength=n_mutations * len(types_bien))
+    pairs = np.unique(group[is_type & has_disposition] * n_dispositions
+                      + disposition[is_type & has_disposition])
+    nunique_type = np.bincount(pairs // n_dispositions, minlength=n_mutations * len(types_bien))
+
+    # Drop the groups of a type where the same property has been counted multiple times
+    group = np.where(is_type, group, 0)
+    keep = is_type & ~((nunique_type[group] == 1) & (size_type[group] > 1))
+
+    if single_disposition:
+        # Number of distinct disposition numbers per mutation
+        pairs = np.unique(mutation[has_disposition] * n_dispositions + disposition[has_disposition])
+        nunique = np.bincount(pairs // n_dispositions, minlength=n_mutations)
+        keep &= nunique[mutation] <= 1
+
+    return keep, type_code
 
 
 def clean_type(data, type_bien):
@@ -28,25 +83,11 @@ def clean_type(data, type_bien):
     """
     print(f"Cleaning data for '{type_bien}...'")
 
-    # Filter data by property type
-    mask = data['type_local'] == type_bien
-    clean_data = data[mask]
-
-    # Find the number of unique disposition numbers for each property group
-    new_data = clean_data.groupby('index_group')['numero_disposition'].nunique()
-
-    # remove any groups where more than one disposition number is found
-    new_data = clean_data[clean_data.index_group.isin(new_data[new_data==1].index)]\
-                .groupby('index_group').size()
-    to_drop = new_data[new_data>1].index
-
-    # drop any rows associated with the remaining groups
-    clean_data = clean_data.drop(clean_data[clean_data.index_group.isin(to_drop)].index)
+    keep, _ = multivente_mask(data, [type_bien], single_disposition=False)
+    return data[keep]
 
-    return clean_data
 
-
-def clean_multivente(data):
+def clean_multivente(data, drop_duplicates=True):
     """
     Clean the given dataset by performing the following operations:
         1. Drop duplicates
@@ -55,8 +96,13 @@ def clean_multivente(data):
         4. If there are multiple rows with the same mutation ID, filter by property 
         type (Appartement ou Maison) and keep only one row for each type.
         
+    Steps 3 and 4 are computed together by multivente_mask. The rows are returned grouped 
+    by property type, 'Appartement' first.
+
     Args:
         data: pandas DataFrame containing geographical data.
+        drop_duplicates (bool, optional): Whether to drop the duplicated rows. Can be disabled 
+        when the duplicates were already dropped while reading the data (see utils.common.read_data).
 
     Returns:
         A pandas DataFrame with cleaned data.
@@ -65,19 +111,13 @@ def clean_multivente(data):
     print("Cleaning multivente data...")
 
     # Drop duplicates and filter for 'vente' transactions
-    data = data.drop_duplicates()
+    if drop_duplicates:
+        data = drop_duplicate_rows(data)
     data = data[data['nature_mutation'] == 'Vente']
 
-    # Create a unique identifier for each mutation using ID and date
-    data['index_group'] = data['id_mutation'].astype(str) + data['date_mutation'].astype(str)
-
-    # Remove mutations with multiple disposition IDs
-    new_data = data.groupby('index_group')['numero_disposition'].nunique()
-    to_drop = new_data[new_data>1].index
-    data = data.drop(data[data.index_group.isin(to_drop)].index)
-
-    # Filter by property type and keep only one row for each type if there are multiple 
-    #rows with the same mutation ID
-    clean_data = pd.concat([clean_type(data, 'Appartement'), clean_type(data, 'Maison')])
+    # Remove mutations with multiple disposition IDs, and mutations where a property 
+    # type has been counted multiple times
+    keep, type_code = multivente_mask(data, TYPES_CLEAN)
+    order = np.flatnonzero(keep)[np.argsort(type_code[keep], kind='stable')]
 
-    return clean_data
+    return data.iloc[order]
@@ -5,11 +5,9 @@ The main function in this module is 'create_columns', which computes
 the discount'coeff_appart_a_maison' and 'coeff_maison_a_appart' and
 apply discounting.
 """
-from datetime import datetime
 import numpy as np
 import pandas as pd
-import swifter
-from tqdm import tqdm
+from utils.common import cached_read, get_positions, map_categories
 
 # Define paths
 PATH_VALEURS_TRIMESTROIELLES = "data/open_data/valeurs_trimestrielles.csv"
@@ -80,152 +78,165 @@ def create_columns(data):
     return data
 
 
-def commune(x):
-    """Convert the input string into a valid commune code string."""
-    commune_name = str(x)
+# Communes discounted with the index of their city rather than the one of their zone
+ZONES_VILLES = {**{name: 'Marseille' for name in liste_Marseille},
+                **{name: 'Lyon' for name in liste_lyon},
+                **{name: 'Paris' for name in liste_paris},
+                'Lille': 'Lille'}
 
-    if len(commune_name) == 4:
-        new_commune = '0' + commune_name
 
-    return new_commune
+def commune(codes):
+    """Convert a Series of commune codes into valid 5 characters commune code strings."""
+    return map_categories(codes, lambda code: code.astype(str).str.zfill(5))
 
 
-def fill_zone(data: pd.DataFrame):
+def get_zone_table(zone):
+    """
+    Build the mapping of the commune codes to their 'Zone ABC' from the zonage table.
+
+    Args:
+        zone (pd.DataFrame): The zonage table, with the 'Code Commune' and 'Zone ABC' columns.
+
+    Returns:
+        pd.Series: The 'Zone ABC' of each commune, indexed by the commune code.
+    """
+    zone = zone.assign(**{'Code Commune': zone['Code Commune'].astype(str).str.zfill(5)})
+    return zone.drop_duplicates(subset=['Code Commune']).set_index('Code Commune')['Zone ABC']
+
+
+def fill_zone(data):
     """Fill the missing values of 'Zone ABC' with the corresponding city or 'C' 
     if the city is not in the list.
     """
-    
-    commune_name = data['nom_commune']
-    zone = ''
-
-    if commune_name in liste_Marseille:
-        zone = 'Marseille'
-    elif commune_name in liste_lyon:
-        zone = 'Lyon'
-    elif commune_name in liste_paris:
-        zone = 'Paris'
-    elif commune_name == 'Lille':
-        zone = 'Lille'
-    elif pd.isna(data['Zone ABC']):
-        if commune_name not in liste_complete:
-            zone = 'C'
-    else:
-        zone = data['Zone ABC']
-
-    return zone
-
-
-def get_trimester(data):
-    """Get the trimester based on the date"""
-
-    date = data['date_vente']
-    month = int(date.month)
-    year = date.year
-    trimester = ''
-
-    if month < 4:
-        trimester = 'T1'
-    elif 4 <= month < 7:
-        trimester = 'T2'
-    elif 7 <= month < 10:
-        trimester = 'T3'
-    else:
-        trimester = 'T4'
-
-    trim_vente = str(year) + '-' + str(trimester)
-
-    return trim_vente
-
-def get_coeff_actu(data, base_indice_grand, trimestre_actu):
+    zone = data['nom_commune'].map(ZONES_VILLES).astype(object)
+    return zone.fillna(data['Zone ABC'].astype(object)).fillna('C')
+
+
+# Quarter of each month, as in the 'MM' part of an ISO date
+TRIMESTRES_MOIS = {f'{month:02d}': f'T{(month - 1) // 3 + 1}' for month in range(1, 13)}
+
+
+def get_trimester(dates):
+    """Get the trimesters ('YYYY-TX') of a Series of ISO dates ('YYYY-MM-DD')"""
+    return dates.str[:4] + '-' + dates.str[5:7].map(TRIMESTRES_MOIS)
+
+
+# Zones and property types of the discount coefficients
+ZONES = ['Paris', 'Marseille', 'Lyon', 'Lille', 'A', 'Abis', 'B1', 'B2', 'C']
+TYPES_LOCAL = ['Appartement', 'Maison']
+
+# Price index series used to discount the sales of each zone and property type
+LIBELLE_INDICE = 'Indice des prix des logements anciens - {} - Base 100 en moyenne annuelle 2015 - Série CVS'
+LIBELLES_ZONES = {
+    'Paris': 'Paris - {}',
+    'Marseille': 'Agglomération de Marseille - {}',
+    'Lyon': 'Agglomération de Lyon - {}',
+    'Lille': 'Agglomération de Lille - {}',
+    'A': 'Zone A du Zonage A, B, C',
+    'Abis': 'Zone A bis du Zonage A, B, C',
+    'B1': 'Zone B1 du Zonage A, B, C',
+    'B2': 'Zone B2 du Zonage A, B, C',
+    'C': 'Zone C du Zonage A, B, C',
+}
+
+
+def get_libelle(zone, type_bien):
+    """Return the label of the price index series of a zone and a type of property."""
+    serie = 'Appartements' if type_bien == 'Appartement' else 'Maisons'
+    return LIBELLE_INDICE.format(LIBELLES_ZONES[zone].format(serie))
+
+
+def get_coeff_table(base_indice_grand, trimestres_actu):
     """
-    Calculate the discount coefficient for a given zone and type of property.
+    Compute the discount coefficients of every zone, type of property and quarter, 
+    towards each of the target quarters.
 
     Args:
-        data: A dictionary containing the zone, trimester, and type of property.
-        base_indice_grand: A pandas DataFrame of the base index data for the zone and type of property.
-        trimestre_actu: A string representing the trimester of discount.
+        base_indice_grand: A pandas DataFrame of the index series, with a 'Libellé' column and 
+        a column per quarter.
+        trimestres_actu: A list of strings representing the trimesters of discount.
 
-Returns:
-- coeff: A float representing the coefficient of price evolution.
+    Returns:
+        pd.DataFrame: The coefficients, indexed by (zone, type_local) in the order of ZONES and 
+        TYPES_LOCAL, with a column per (target quarter, quarter of sale). A coefficient is the 
+        ratio of the index of the target quarter to the index of the quarter of the sale.
     """
-    try:
-        # Get the zone, trimester, and type of property from the data
-        zone = data['vrai_zone']
-        trimestre = data['trimestre_vente']
-        type_bien = data['type_local']
-
-        ligne = ''
-
-        # Determine the correct line in the base index based on the zone and type of property
-        if zone == 'Paris':
-            if type_bien == 'Appartement':
-                ligne = 'Indice des prix des logements anciens - Paris - Appartements - \
-                        Base 100 en moyenne annuelle 2015 - Série CVS'
-            else:
-                ligne = 'Indice des prix des logements anciens - Paris - Maisons - Base 100 en moyenne annuelle 2015 - Série CVS'
-        elif zone == 'Marseille':
-            if type_bien == 'Appartement':
-                ligne = 'Indice des prix des logements anciens - Agglomération de Marseille - Appartements - Base 100 en moyenne annuelle 2015 - Série CVS'
-            else:
-                ligne = 'Indice des prix des logements anciens - Agglomération de Marseille - Maisons - Base 100 en moyenne annuelle 2015 - Série CVS'
-        elif zone == 'Lyon':
-            if type_bien == 'Appartement':
-                ligne = 'Indice des prix des logements anciens - Agglomération de Lyon - Appartements - Base 100 en moyenne annuelle 2015 - Série CVS'
-            else:
-                ligne = 'Indice des prix des logements anciens - Agglomération de Lyon - Maisons - Base 100 en moyenne annuelle 2015 - Série CVS'
-        elif zone == 'Lille':
-            if type_bien == 'Appartement':
-                ligne = 'Indice des prix des logements anciens - Agglomération de Lille - Appartements - Base 100 en moyenne annuelle 2015 - Série CVS'
-            else:
-                ligne = 'Indice des prix des logements anciens - Agglomération de Lille - Maisons - Base 100 en moyenne annuelle 2015 - Série CVS'
-        elif zone == 'A':
-            ligne = "Indice des prix des logements anciens - Zone A du Zonage A, B, C - Base 100 en moyenne annuelle 2015 - Série CVS"
-        elif zone == 'Abis':
-            ligne = "Indice des prix des logements anciens - Zone A bis du Zonage A, B, C - Base 100 en moyenne annuelle 2015 - Série CVS"
-        elif zone == 'B1':
-            ligne = "Indice des prix des logements anciens - Zone B1 du Zonage A, B, C - Base 100 en moyenne annuelle 2015 - Série CVS"
-        elif zone == 'B2':
-            ligne="Indice des prix des logements anciens - Zone B2 du Zonage A, B, C - Base 100 en moyenne annuelle 2015 - Série CVS"
-        elif zone=='C':
-            ligne="Indice des prix des logements anciens - Zone C du Zonage A, B, C - Base 100 en moyenne annuelle 2015 - Série CVS"
-        else:
-            raise ValueError('Invalid zone:', zone)
+    indices = base_indice_grand.set_index('Libellé').astype('float')
+    keys = pd.MultiIndex.from_product([ZONES, TYPES_LOCAL], names=['vrai_zone', 'type_local'])
+    indices = indices.reindex([get_libelle(zone, type_bien) for zone, type_bien in keys])
+    indices.index = keys
 
-        # Select the row of interest from the dataframe
-        # The row is identified by the 'Libellé' column matching the 'ligne' string
-        données = base_indice_grand[base_indice_grand['Libellé'].isin([ligne])]
+    return pd.concat({trimestre_actu: indices.rdiv(indices[trimestre_actu], axis=0)
+                      for trimestre_actu in trimestres_actu}, axis=1)
 
-        # Extract the index values for the current and base quarters
-        # Convert the values to floats
-        indice_ancien = données[trimestre].apply(lambda x: float(x))
-        indice_actu = données[trimestre_actu].apply(lambda x: float(x))
 
-        # The coefficient represents the ratio of the current index to the base index
-        # It is calculated as (current index - base index) / base index + 1
-        coeff = float(((indice_actu - indice_ancien) / indice_ancien) + 1)
+def get_coeff_actu(data, coeff_table):
+    """
+    Look up the discount coefficients of every sale.
+
+    Args:
+        data: A pandas DataFrame with the 'vrai_zone', 'trimestre_vente' and 'type_local' columns.
+        coeff_table: The coefficients returned by get_coeff_table.
+
+    Returns:
+        np.ndarray: The coefficients, of shape (number of sales, number of target quarters). 
+        NaN for unknown zones or quarters outside the index table.
+    """
+    trimestres_actu = coeff_table.columns.unique(level=0)
+    trimestres = coeff_table[trimestres_actu[0]].columns
+    coeffs = coeff_table.to_numpy().reshape(len(coeff_table), len(trimestres_actu), len(trimestres))
 
-        # Return the coefficient
-        return coeff
-    except KeyError as e:
-        print(f"KeyError occurred: {str(e)}. The data dictionary may not have the expected key.")
+    zone = get_positions(pd.Index(ZONES), data['vrai_zone'])
+    type_bien = get_positions(pd.Index(TYPES_LOCAL), data['type_local'])
+    trimestre = get_positions(trimestres, data['trimestre_vente'])
+
+    coeffs = coeffs[zone * len(TYPES_LOCAL) + type_bien, :, trimestre]
+    valid = (zone >= 0) & (type_bien >= 0) & (trimestre >= 0)
+    return np.where(valid[:, None], coeffs, np.nan)
+
+def read_discount_tables():
+    """
+    Read the tables used to discount the prices.
+
+    Returns:
+        tuple: The real estate indices table and the real estate areas (zonage ABC) table, 
+        or None if they could not be read.
+    """
+    try:
+        print('Reading discount tables...')
+        base_indice = pd.read_csv(PATH_VALEURS_TRIMESTROIELLES,sep=';')
+        zonage = cached_read(PATH_ZONAGE_IMMO, pd.read_excel, engine='openpyxl')
+        return base_indice, zonage
+    except Exception as e:
+        print(f"An error occurred while reading discount tables: {e}")
         return None
 
-def fonction_final_prix(data, trimestre_actu, actulisation=True):
+
+def fonction_final_prix(data, trimestre_actu, actulisation=True, tables=None):
 
     """
     Compute the updated real estate price per square meter using the actualisation coefficient.
 
+    Several target quarters can be given at once: the zones, trimesters and coefficients are 
+    computed in a single pass, and a 'prix_m2_actualise_<quarter>' column is added for each 
+    target. 'coeff_actu', 'prix_actualise' and 'prix_m2_actualise' refer to the first one.
+
     Args:
         data (pd.DataFrame): The real estate data to be processed.
-        trimestre_actu (str): The discounted quarter.
+        trimestre_actu (str or list of str): The discounted quarter(s).
         actulisation (bool, optional): Whether to apply actualisation or not. Defaults to True.
+        tables (tuple, optional): The indices and areas tables, if already loaded 
+        (see read_discount_tables).
 
     Returns:
         pd.DataFrame: The joined data with the updated real estate price per square meter.
     """
     try:
+        if tables is None:
+            tables = read_discount_tables()
+        base_indice, zonage = tables
+
         # Process the real estate indices table
-        base_indice = pd.read_csv(PATH_VALEURS_TRIMESTROIELLES,sep=';')
         base_indice = base_indice[['Libellé','2016-T1', '2016-T2', '2016-T3', '2016-T4', '2017-T1', '2017-T2',
         '2017-T3', '2017-T4', '2018-T1', '2018-T2', '2018-T3', '2018-T4',
         '2019-T1', '2019-T2', '2019-T3', '2019-T4', '2020-T1', '2020-T2',
@@ -253,27 +264,27 @@ def fonction_final_prix(data, trimestre_actu, actulisation=True):
         base_indice_grand = base_indice_grand.reset_index()
 
         # Import of the real estate areas table
-        zone = pd.read_excel(PATH_ZONAGE_IMMO, engine='openpyxl')
-        zone = zone.rename(columns={'Nom Commune': 'nom_commune'})
+        zone_table = get_zone_table(zonage)
 
-        # Join dvf and area table, then replace missing values
-        data['Code Commune'] = data['code_commune'].apply(lambda x: commune(x)).astype("str")
-        joined_data = pd.merge(data, zone,how="left", on='Code Commune')
-        
-        joined_data['vrai_zone'] = joined_data.apply(lambda x: fill_zone(x),axis=1)
+        # Look up the area of each commune, then replace missing values
+        joined_data = data.copy()
+        joined_data['Code Commune'] = commune(joined_data['code_commune'])
+        joined_data['Zone ABC'] = joined_data['Code Commune'].map(zone_table)
+        joined_data['vrai_zone'] = fill_zone(joined_data)
         
-        # Get the sale trimesters
-        joined_data['date_vente'] = joined_data['date_mutation'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d'))
-        joined_data['trimestre_vente'] = joined_data.apply(lambda x: get_trimester(x),axis=1)
+        # Get the sale trimesters, computed once per distinct date
+        joined_data['trimestre_vente'] = map_categories(joined_data['date_mutation'], get_trimester)
         
         if actulisation:
         
             print('Starting discount...')
         
-            # Compute the actualisation coefficient
-            joined_data['coeff_actu'] = list(tqdm(joined_data.swifter.apply(lambda x: get_coeff_actu(x,base_indice_grand,trimestre_actu),axis=1),
-                                        total=len(joined_data)))
-            drop_zone_list = ['Zone ABC','vrai_zone','date_vente']
+            # Compute the actualisation coefficients
+            trimestres_actu = [trimestre_actu] if isinstance(trimestre_actu, str) else list(trimestre_actu)
+            coeff_table = get_coeff_table(base_indice_grand, trimestres_actu)
+            coeffs = get_coeff_actu(joined_data, coeff_table)
+            joined_data['coeff_actu'] = coeffs[:, 0]
+            drop_zone_list = ['Zone ABC','vrai_zone']
             joined_data = joined_data.drop(columns=drop_zone_list)
 
             # Add columns
@@ -282,6 +293,13 @@ def fonction_final_prix(data, trimestre_actu, actulisation=True):
             joined_data['prix_actualise'] = joined_data['valeur_fonciere'] * joined_data['coeff_actu']
             joined_data['prix_m2_actualise'] = joined_data['prix_actualise'] / joined_data['surface_reelle_bati']
             joined_data['prix_m2'] = joined_data['valeur_fonciere'] / joined_data['surface_reelle_bati']
+
+            if not isinstance(trimestre_actu, str):
+                for i, trimestre in enumerate(trimestres_actu):
+                    joined_data[f'prix_m2_actualise_{trimestre}'] = joined_data['prix_m2'] * coeffs[:, i]
+        else:
+            # The sale dates are only kept in the output when the prices are not discounted
+            joined_data['date_vente'] = pd.to_datetime(joined_data['date_mutation'], format='%Y-%m-%d')
             
         return joined_data        
     except Exception as e:
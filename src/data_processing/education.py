@@ -2,33 +2,31 @@
 This module provides functions to preprocess data on schools and merge it with DVF data.
 
 Functions:
-    prep_lyc(data: pd.DataFrame, geo_etab: pd.DataFrame) -> gpd.GeoDataFrame
+    prep_lyc(data: pd.DataFrame, geo_etab: pd.DataFrame) -> pd.DataFrame
     Filters the given lycée data to only include lycées généraux, calculates the taux de mention for
-    each lycée and converts the result to a geopandas dataframe, which is then merged with
-    the dvf data.
+    each lycée and adds its coordinates, to be merged with the dvf data.
 
-    prep_brevet(data, geo_etab): Preprocesses brevet data by computing the taux de mention for each college,
-    converting it to a geopandas dataframe, and merging it with the DVF dataframe.
+    prep_brevet(data, geo_etab): Preprocesses brevet data by computing the taux de mention for each college
+    and adding its coordinates, to be merged with the DVF dataframe.
 
 """
 
 import pandas as pd
-import geopandas as gpd
 
 
-def prep_lyc(data: pd.DataFrame, geo_etab: pd.DataFrame) -> gpd.GeoDataFrame:
+def prep_lyc(data: pd.DataFrame, geo_etab: pd.DataFrame) -> pd.DataFrame:
     """
     Filters the given lycée data to only include lycées généraux, as they are more likely to
     influence housing prices than other types of schools. Calculates the taux de mention for
-    each lycée and converts the result to a geopandas dataframe, which is then merged with
-    the dvf data.
+    each lycée and adds its coordinates, which are then used to merge it with the dvf data.
+    No geometry is built: the nearest neighbour search works on the coordinates.
 
     Args:
         data (pd.DataFrame): a pandas DataFrame containing data on lycées
         geo_etab (pd.DataFrame): a pandas DataFrame containing geographical data on the lycées
 
     Returns:
-        A geopandas GeoDataFrame with the filtered and processed lycée data
+        A pandas DataFrame with the filtered and processed lycée data, and their latitude and longitude
     """    
     try:
         # Start by filtering out the data for years other than 2020 and keeping only lycées généraux
@@ -51,10 +49,8 @@ def prep_lyc(data: pd.DataFrame, geo_etab: pd.DataFrame) -> gpd.GeoDataFrame:
                 'Taux de mentions - L', 'Taux de mentions - ES', 'Taux de mentions - S', 'taux_mention',
                 'latitude', 'longitude']]
         lyc_gen.rename(columns = {'Taux de mentions - L':'taux_mention_L', 'Taux de mentions - ES':'taux_mention_ES', 'Taux de mentions - S':'taux_mention_S'}, inplace=True)
-        # Convert the resulting DataFrame to a geopandas GeoDataFrame, and filter out any rows with missing geographic data
-        lyc_gen_geo = gpd.GeoDataFrame(
-            lyc_gen, geometry = gpd.points_from_xy(lyc_gen.longitude, lyc_gen.latitude))
-        lyc_gen_geo = lyc_gen_geo[(lyc_gen_geo['latitude'].notna()) & (lyc_gen_geo['longitude'].notna())]
+        # Filter out any rows with missing geographic data
+        lyc_gen_geo = lyc_gen[(lyc_gen['latitude'].notna()) & (lyc_gen['longitude'].notna())]
 
         return lyc_gen_geo
     except Exception as e:
@@ -62,17 +58,17 @@ def prep_lyc(data: pd.DataFrame, geo_etab: pd.DataFrame) -> gpd.GeoDataFrame:
         return None
 
 
-def prep_brevet(data: pd.DataFrame, geo_etab: pd.DataFrame) -> gpd.GeoDataFrame:
+def prep_brevet(data: pd.DataFrame, geo_etab: pd.DataFrame) -> pd.DataFrame:
     """
-    Preprocesses brevet data by computing the taux de mention for each college,
-    converting it to a geopandas dataframe, and merging it with the DVF dataframe.
+    Preprocesses brevet data by computing the taux de mention for each college
+    and adding its coordinates, which are then used to merge it with the DVF dataframe.
 
     Args:
         data (pd.DataFrame): a pandas DataFrame containing data on lycées
         geo_etab (pd.DataFrame): a pandas DataFrame containing geographical data on the lycées
 
     Returns:
-        A geopandas GeoDataFrame with the filtered and processed lycée data
+        A pandas DataFrame with the filtered and processed college data, and their latitude and longitude
     """
     try:
         brevet = data[data['session'] == 2021]
@@ -82,8 +78,6 @@ def prep_brevet(data: pd.DataFrame, geo_etab: pd.DataFrame) -> gpd.GeoDataFrame:
                                 'latitude', 'longitude']]
         brevet_geo['taux_mention'] = brevet_geo['nombre_d_admis_mention_tb'] / brevet_geo['nombre_total_d_admis']
 
-        brevet_geo = gpd.GeoDataFrame(
-            brevet_geo, geometry = gpd.points_from_xy(brevet_geo.longitude, brevet_geo.latitude))
         brevet_geo = brevet_geo[(brevet_geo['latitude'].notna()) & (brevet_geo['longitude'].notna())]
 
         return brevet_geo
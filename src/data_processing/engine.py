@@ -2,144 +2,311 @@
 The preprocessing_engine function plays a crucial role in the data preprocessing pipeline. 
 It accepts a list of file paths as input and executes a series of preprocessing steps on DVF data, 
 resulting in a complete end-to-end processing workflow. The final processed data is then saved to 
-the designated folder, namely 'data/processed'.
+the designated folder, namely 'data/processed/processed_data', as a parquet dataset partitioned 
+by metropole and property type.
+
+The steps are grouped in stages (read_stage, clean_stage, discount_stage, neighbors_stage, 
+iris_stage and amenity_stage). The output of each stage is checkpointed, keyed on its inputs 
+and parameters (see utils.pipeline), so that a new run resumes from the first stage whose 
+inputs changed: only the checkpoint of the stage before it is loaded. The time, memory and number of rows of each stage are written to a JSON report 
+in 'output/reports'.
+
+The reference tables (metropoles, discount indices and zonage, schools, IRIS, amenities) do not 
+depend on the DVF data: those of the stages to run are loaded in a pool of threads from the start 
+of the run, and each stage only waits for the tables it reads (see REFERENCE_LOADERS and 
+STAGE_INPUTS).
 """
 import logging
 import traceback
-import os
 import pandas as pd
-from utils.common import convert_gpd, read_data, read_iris, iris_prep
+from utils.common import (
+    assign_iris, compact_dtypes, iris_mapping_path, PRIX_ACTUALISE_PREFIX, read_data, read_equi, read_iris, iris_prep,
+    write_processed,
+    PROCESSED_DATA_PATH,
+    BPE_DATA_PATH, DVF_CHUNKSIZE, DVF_COLUMNS, DVF_DTYPES, IRIS_SHAPE_PATH, IRIS_VALUE_PATH
+    )
+from utils.pipeline import last_checkpoint, new_report, run_stages, stage_key, start_loads, write_report
 from data_processing.amenities import equipements_prep
 from data_processing.clean import clean_multivente
-from data_processing.discount import fonction_final_prix
+from data_processing.discount import (
+    fonction_final_prix, read_discount_tables, PATH_VALEURS_TRIMESTROIELLES, PATH_ZONAGE_IMMO
+    )
 from data_processing.education import prep_brevet, prep_lyc
-from data_processing.filters import select_bien, filtre_dur, filtre_prix
+from data_processing.filters import mask_vente, select_bien, filtre_dur, filtre_prix
 from data_processing.utilities import (
-    calculate_closest_metric, choose_metric_name, 
-    get_top_zones, read_lycees, 
-    select_variables
+    calculate_closest_metric, calculate_neighbor_features, choose_metric_name, compute_by_location,
+    get_top_zones, liste_var_garder, read_lycees, read_metropoles,
+    select_variables, NEIGHBOR_ENGINE,
+    BREVET_PATH, GEO_ETAB_PATH, LYCEES_PATH, METROPOLES_PATH
     )
 
-def preprocessing_engine(data_paths, trimestre_actu='2022-T2'):
-    """
-    Main engine of preprocessing. Preprocesses DVF data in an end-to-end fashion.
-    
-    Args:
-        data_paths (list of str): A list of file paths where DVF data is stored.
-        trimestre_actu (str): A string representing the current quarter in the format 
-        "YYYY-TX" (e.g., "2022-T2").
 
-    Returns:
-        A boolean value of True if the processing succeeded, or False if it failed.
-    """
+# Options of the DVF read. They are part of the key of the read stage, the predicate by its name
+DVF_READ_OPTIONS = {'columns': DVF_COLUMNS, 'dtype': DVF_DTYPES, 'chunksize': DVF_CHUNKSIZE,
+                    'predicate': mask_vente, 'drop_duplicates': True, 'count_column': 'nom_commune',
+                    'compact': True}
 
-    test_trimestre = ['2021-T3','2021-T4','2022-T1','2022-T2']
-    surface_max_maison = 360
-    surface_max_appartement = 200
-    nombre_pieces_max_maison = 10
-    nombre_max_appartement = 6
+# Version of the code of each stage, part of its key: increase it when the code of a stage
+# changes its output, so that the checkpoints of the stage and of the stages after it are
+# not reused
+STAGE_VERSIONS = {'read': 1, 'clean': 1, 'discount': 1, 'neighbors': 1, 'iris': 1, 'amenity': 1}
 
-    try:
-        # Read data
-        data = read_data(data_paths)
+# Reference tables read by the stages, by the name of the argument of the stage functions
+# they are passed as. They do not depend on the DVF data, so they are loaded in the background
+# from the start of a run (see start_loads)
+REFERENCE_LOADERS = {
+    'metropoles': read_metropoles,
+    'discount_tables': read_discount_tables,
+    'lycees': read_lycees,
+    'iris_tables': read_iris,
+    'amenities': read_equi,
+}
+# Reference tables read by each stage
+STAGE_INPUTS = {
+    'read': ['metropoles'],
+    'discount': ['discount_tables'],
+    'neighbors': ['lycees'],
+    'iris': ['iris_tables'],
+    'amenity': ['amenities'],
+}
+
+
+def read_stage(data_paths, n_jobs, nb_top_zones, counts=None, metropoles=None):
+    """
+    Read data, streaming only the columns used by the pipeline, and keep the top metropoles. 
+    Rows that are not sales, and duplicated rows, are dropped while the files are parsed. The 
+    metropoles are ranked on the transactions of every row parsed, as counted by commune while 
+    the files are read.
+    """
+    counts = {} if counts is None else counts
+    read_counts = {}
+    data = read_data(data_paths, n_jobs=n_jobs, counts=read_counts, **DVF_READ_OPTIONS)
+    if data is None:
+        return None
+    commune_counts = read_counts.pop('values')
+    counts.update(read_counts)
+    # The integer columns of the chunks may have been compacted to different types
+    data = compact_dtypes(data)
+
+    # Select the top 10 metropoles
+    data = get_top_zones(data, nb_top_zones, metropoles, commune_counts)
+    if data is not None:
+        counts['top_zones'] = len(data)
         print('Ready to start preprocessing')
         print('****************************')
-    except FileNotFoundError:
-        print("Error: data file not found")
-        return False
+    return data
 
-    try:
-        # Select the top 10 metropoles
-        data_top = get_top_zones(data,10)
 
-        #Clean the data to keep only multiventes
-        clean_data = clean_multivente(data_top)
-        
-        #Apply filters to select properties of interest
-        dvf = select_bien(clean_data)
-        dvf = filtre_dur(dvf, surface_max_maison, nombre_pieces_max_maison, 'Maison')
-        dvf = filtre_dur(dvf, surface_max_appartement, nombre_max_appartement, 'Appartement')
+def clean_stage(data, seuils_dur, counts=None):
+    """
+    Clean the multiventes and filter out the outlier properties.
+    """
+    counts = {} if counts is None else counts
 
-        # Discounting price
-        dvf = fonction_final_prix(dvf, trimestre_actu=trimestre_actu)
+    #Clean the data to keep only multiventes
+    clean_data = clean_multivente(data, drop_duplicates=False)
+    counts['multivente'] = len(clean_data)
 
-        # TSplit the data into training and testing datasets
-        dvf_train = dvf.loc[~dvf['trimestre_vente'].isin(test_trimestre)]
-        dvf_test = dvf.loc[dvf['trimestre_vente'].isin(test_trimestre)]
+    #Apply filters to select properties of interest
+    dvf = select_bien(clean_data)
+    counts['select_bien'] = len(dvf)
+    dvf = filtre_dur(dvf, seuils_dur)
+    counts['filtre_dur'] = len(dvf)
+    return dvf
 
-        # Filter the prices of the datasets
-        dvf_train = filtre_prix(dvf_train,'prix_m2_actualise')
-        dvf_test = filtre_prix(dvf_test,'prix_m2')
-        
-        # Concatenate train and test data
-        dvf = pd.concat([dvf_train, dvf_test])
 
-        # Convert data to geopandas
-        dvf_geo = convert_gpd(dvf_train)
+def discount_stage(dvf, trimestre_actu, test_trimestre, counts=None, discount_tables=None):
+    """
+    Discount the prices, and filter the prices of the training dataset.
+    """
+    counts = {} if counts is None else counts
+
+    # Discounting price
+    dvf = fonction_final_prix(dvf, trimestre_actu=trimestre_actu, tables=discount_tables)
+    if dvf is None:
+        return None
+    dvf = compact_dtypes(dvf)
+    counts['discounted'] = len(dvf)
+
+    # TSplit the data into training and testing datasets
+    dvf_train = dvf.loc[~dvf['trimestre_vente'].isin(test_trimestre)]
+    counts['train'] = len(dvf_train)
 
-        # Create the variable "prix moyen au m2 des 10 biens les plus proches"
-        dvf_geo = calculate_closest_metric(dvf = dvf_geo,
-                table_info = dvf_geo[~dvf_geo['trimestre_vente'].isin(test_trimestre)],
-                k_neighbors = 10,
-                metric_of_interest = 'prix_m2_actualise',
-                new_metric_name = 'prix_m2_zone')
-        dvf_geo = dvf_geo.reset_index(drop=True)
+    # Filter the prices of the dataset
+    dvf_train = filtre_prix(dvf_train, 'prix_m2_actualise')
+    counts['filtre_prix'] = len(dvf_train)
+    return dvf_train
 
 
-        # Get the taux de mention for each lycée and collège as well as their geographical coordinates
-        geo_etab, brevet, lyc = read_lycees()
-        lyc_gen_geo = prep_lyc(lyc, geo_etab)
-        brevet_geo = prep_brevet(brevet, geo_etab)
+def neighbors_stage(dvf_geo, test_trimestre, prix_zone_features, lycees=None):
+    """
+    Compute the features of the closest properties and schools of each property.
+    """
+    # The neighbour stages work on the coordinates, no geometry is built
+    dvf_geo = dvf_geo.reset_index(drop=True)
+
+    # Create the variable "prix moyen au m2 des 10 biens les plus proches". The neighbours only
+    # depend on the location, so they are searched once per distinct location
+    dvf_geo = compute_by_location(dvf_geo, calculate_neighbor_features,
+            table_info = dvf_geo[~dvf_geo['trimestre_vente'].isin(test_trimestre)],
+            specs = prix_zone_features)
+    dvf_geo = dvf_geo.reset_index(drop=True)
+
 
-        # Calculate the average 'taux de mention' of the 3 closest 'lycées' for each property
-        dvf_geo = calculate_closest_metric(dvf=dvf_geo, table_info=lyc_gen_geo,
-                                            k_neighbors=3,
-                                            metric_of_interest='taux_mention',
-                                            new_metric_name='moyenne')
+    # Get the taux de mention for each lycée and collège as well as their geographical coordinates
+    geo_etab, brevet, lyc = lycees if lycees is not None else read_lycees()
+    lyc_gen_geo = prep_lyc(lyc, geo_etab)
+    brevet_geo = prep_brevet(brevet, geo_etab)
 
-        # Calculate the average 'taux de mention' of the 3 closest 'collèges' for each property
-        dvf_geo = calculate_closest_metric(dvf=dvf_geo, table_info=brevet_geo,
-                                            k_neighbors=3,
-                                            metric_of_interest='taux_mention',
-                                            new_metric_name='moyenne_brevet')
+    # Calculate the average 'taux de mention' of the 3 closest 'lycées' for each property
+    dvf_geo = compute_by_location(dvf_geo, calculate_closest_metric, table_info=lyc_gen_geo,
+                                        k_neighbors=3,
+                                        metric_of_interest='taux_mention',
+                                        new_metric_name='moyenne')
+
+    # Calculate the average 'taux de mention' of the 3 closest 'collèges' for each property
+    return compute_by_location(dvf_geo, calculate_closest_metric, table_info=brevet_geo,
+                                        k_neighbors=3,
+                                        metric_of_interest='taux_mention',
+                                        new_metric_name='moyenne_brevet')
+
+
+def iris_stage(dvf_geo, iris_tables=None):
+    """
+    Add information about the IRIS area of each property, and its income metrics.
+    """
+    iris_value, iris_shape = iris_tables if iris_tables is not None else read_iris()
+    iris = iris_prep(iris_value, iris_shape)
+    dvf_geo['DCOMIRIS'] = assign_iris(dvf_geo, iris_shape, iris_mapping_path())
+    dvf_geo = dvf_geo.merge(pd.DataFrame(iris.drop(columns='geometry')), how='left', on='DCOMIRIS')
+    dvf_geo = compact_dtypes(dvf_geo)
 
-        # Add information about the IRIS area
-        iris_value, iris_shape = read_iris()
-        iris = iris_prep(iris_value, iris_shape)
-        dvf_geo = dvf_geo.sjoin(iris, how = 'left', predicate = 'within')
+    #Choose the metric name for income
+    return choose_metric_name(dvf_geo,'income')
 
-        #Choose the metric name for income
-        dvf_geo = choose_metric_name(dvf_geo,'income')
 
+def amenity_stage(dvf_geo, prix_zone_features, amenities=None):
+    """
+    Add information about the equipment available in the IRIS area of each property, and keep 
+    the relevant variables.
+    """
+    liste_iris = dvf_geo['DCOMIRIS'].unique()
+    equipements = equipements_prep(liste_iris, amenities)
 
-        #Add information about the equipment available in the area
-        liste_iris = dvf_geo['DCOMIRIS'].unique()
-        equipements = equipements_prep(liste_iris)
+    dvf_geo = dvf_geo.merge(equipements, how = 'left', left_on = 'DCOMIRIS', right_on = 'DCIRIS')
+    dvf_geo = choose_metric_name(dvf_geo,'amenity')
 
-        dvf_geo = dvf_geo.merge(equipements, how = 'left', left_on = 'DCOMIRIS', right_on = 'DCIRIS')
-        dvf_geo = choose_metric_name(dvf_geo,'amenity')
+    # Select the relevant variables
+    keep_columns = liste_var_garder + [col for col in dvf_geo.columns
+                                       if col.startswith(PRIX_ACTUALISE_PREFIX)]
+    keep_columns += [spec[3] for spec in prix_zone_features if spec[3] not in keep_columns]
+    return select_variables(dvf_geo, keep_columns)
 
-        # Select the relevant variables
-        dvf_geo = select_variables(dvf_geo)
 
+def preprocessing_engine(data_paths, trimestre_actu='2022-T2', n_jobs=1, resume=True, trace_memory=False):
+    """
+    Main engine of preprocessing. Preprocesses DVF data in an end-to-end fashion.
+    
+    Args:
+        data_paths (list of str): A list of file paths where DVF data is stored.
+        trimestre_actu (str or list of str): A string representing the current quarter in the format 
+        "YYYY-TX" (e.g., "2022-T2"). If a list is given, prices are discounted to each quarter 
+        (see fonction_final_prix) and the first one is used as the target.
+        n_jobs (int): The number of worker processes used to read the files in parallel 
+        (-1 to use all cores).
+        resume (bool): Whether to reuse the checkpoints of the stages whose inputs, parameters 
+        and code version (see STAGE_VERSIONS) are unchanged since an earlier run. Otherwise the 
+        stages are run without checkpoint.
+        trace_memory (bool): Whether to report the memory allocated during each stage with 
+        tracemalloc, which slows the stages down.
+
+    Returns:
+        A boolean value of True if the processing succeeded, or False if it failed.
+    """
+
+    test_trimestre = ['2021-T3','2021-T4','2022-T1','2022-T2']
+    nb_top_zones = 10
+    # Maximum building surface and number of rooms by property type. Entries keyed by
+    # (metropole, property type) override them in a given metropole
+    seuils_dur = {'Maison': (360, 10), 'Appartement': (200, 6)}
+    # Features computed from the prices of the closest properties, as (k, column, statistic, name).
+    # Variants with other k or statistics are computed from the same neighbour query
+    prix_zone_features = [(10, 'prix_m2_actualise', 'mean', 'prix_m2_zone')]
+
+    report = new_report('preprocessing', trace_memory=trace_memory)
+    # The files are read in a fixed order, which their key depends on
+    data_paths = sorted(data_paths)
+
+    # Without resume, the stages are run without checkpoint and the input files are not hashed
+    keys = dict.fromkeys(STAGE_VERSIONS)
+    try:
+        # The keys of the stages only depend on the files and the parameters, so the stages
+        # loaded from their checkpoint are known before running any of them
+        if resume:
+            read_params = {**DVF_READ_OPTIONS, 'predicate': DVF_READ_OPTIONS['predicate'].__name__,
+                           'nb_top_zones': nb_top_zones, 'version': STAGE_VERSIONS['read']}
+            keys['read'] = stage_key(None, 'read', read_params, data_paths + [METROPOLES_PATH])
+            keys['clean'] = stage_key(keys['read'], 'clean',
+                                      {'seuils_dur': seuils_dur, 'version': STAGE_VERSIONS['clean']})
+            keys['discount'] = stage_key(keys['clean'], 'discount',
+                                         {'trimestre_actu': trimestre_actu, 'test_trimestre': test_trimestre,
+                                          'version': STAGE_VERSIONS['discount']},
+                                         [PATH_VALEURS_TRIMESTROIELLES, PATH_ZONAGE_IMMO])
+            keys['neighbors'] = stage_key(keys['discount'], 'neighbors',
+                                          {'prix_zone_features': prix_zone_features, 'engine': NEIGHBOR_ENGINE,
+                                           'version': STAGE_VERSIONS['neighbors']},
+                                          [GEO_ETAB_PATH, BREVET_PATH, LYCEES_PATH])
+            keys['iris'] = stage_key(keys['neighbors'], 'iris', {'version': STAGE_VERSIONS['iris']},
+                                     [IRIS_VALUE_PATH, IRIS_SHAPE_PATH])
+            keys['amenity'] = stage_key(keys['iris'], 'amenity',
+                                        {'keep_columns': liste_var_garder, 'version': STAGE_VERSIONS['amenity']},
+                                        [BPE_DATA_PATH])
+    except FileNotFoundError:
+        print("Error: data file not found")
+        return False
+
+    # Start reading the reference tables of the stages to run, so that they are loaded while
+    # the DVF data is read, cleaned and discounted. A resumed run only runs the stages after
+    # the last checkpoint
+    stage_names = list(STAGE_VERSIONS)
+    to_run = stage_names[last_checkpoint(stage_names, keys) + 1:] if resume else stage_names
+    tables = start_loads({name: REFERENCE_LOADERS[name] for stage in to_run
+                          for name in STAGE_INPUTS.get(stage, [])})
+    inputs = {stage: {name: tables.get(name) for name in names} for stage, names in STAGE_INPUTS.items()}
+
+    stages = [
+        ('read', read_stage, (data_paths, n_jobs, nb_top_zones), {'counts': {}, 'inputs': inputs['read']}),
+        ('clean', clean_stage, (seuils_dur,), {'counts': {}}),
+        ('discount', discount_stage, (trimestre_actu, test_trimestre),
+         {'counts': {}, 'inputs': inputs['discount']}),
+        ('neighbors', neighbors_stage, (test_trimestre, prix_zone_features), {'inputs': inputs['neighbors']}),
+        ('iris', iris_stage, (), {'inputs': inputs['iris']}),
+        ('amenity', amenity_stage, (prix_zone_features,), {'inputs': inputs['amenity']}),
+    ]
+    try:
+        dvf_geo = run_stages(stages, keys, resume=resume, report=report)
     except Exception as e:
         logging.error("An error occurred while performing pre-processing: %s", e)
         print(traceback.format_exc())
+        # Do not start the loads still waiting for a thread
+        for future in tables.values():
+            future.cancel()
+        # Report the stages run before the failure
+        write_report(report)
         return False  
     
     try:
-        # Save the processed data
-        output_dir = "data/processed"
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        output_file = os.path.join(output_dir, "processed_data.csv")
-        pd.DataFrame(dvf_geo).to_csv(output_file, index=False)
+        # Save the processed data, partitioned by metropole and property type
+        write_processed(dvf_geo, PROCESSED_DATA_PATH)
         
         print('Finished pre-processing')
         print('****************************')
-        print('Processed data saved to', output_dir)
-    except IOError:
+        print('Processed data saved to', PROCESSED_DATA_PATH)
+    except (IOError, ValueError):
         print("Error: could not write processed data to file")
         return False
 
+    report_path = write_report(report)
+    if report_path is not None:
+        print('Run report saved to', report_path)
     return True
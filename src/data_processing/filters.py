@@ -3,14 +3,64 @@ This module contains functions for filtering and selecting data from a given dat
 
 Functions:
 
+    -mask_vente(df): Return the boolean mask of the transactions of type 'Vente'.
+    -mask_bien(df): Return the boolean mask of the properties of type 'Maison' or 'Appartement' that are being sold.
     -select_bien(df): Filter the dataset to keep only properties of type 'Maison' or 'Appartement' that are being sold.
-    -filtre_dur(df, bati, piece, local, metropole_name=None): Filter the dataset to keep only properties of a given type,
-    within or outside a given metropolitan area, and within given building surface and number of rooms constraints.
-    -filtre_prix(df, metric_prix, quantile_nv = 0.99): Filter the dataset to keep only properties with a price per square 
-    meter below the 99th percentile for each city and property type.
+    -filtre_dur(df, seuils, piece=None, local=None, metropole_name=None): Filter the dataset to keep only properties
+    within the building surface and number of rooms constraints given for their type and metropolitan area.
+    -grouped_quantile(values, codes, quantile_nv): Compute a quantile of the values of each group in a single sort.
+    -quantile_sketch(df, metric_prix): Summarize the prices of each city and property type as a mergeable histogram.
+    -merge_sketches(sketches): Combine the sketches of several chunks of data.
+    -sketch_quantiles(sketch, quantile_nv): Approximate a quantile of the prices of each city and property type from a sketch.
+    -filtre_prix(df, metric_prix, quantile_nv = 0.99, sketch=None): Filter the dataset to keep only properties with a price 
+    per square meter below the 99th percentile for each city and property type.
 """
 import pandas as pd
 import numpy as np
+from utils.common import get_positions
+
+
+TYPES_BIEN = ['Maison', 'Appartement']
+
+# Range of the prices per square meter kept by filtre_prix, and width of the bins of its sketches
+PRIX_MIN = 1000
+PRIX_MAX = 20000
+PRIX_BIN_WIDTH = 10
+
+
+def mask_vente(df):
+    """
+    Return the mask of the transactions of type 'Vente'.
+
+    The multivente cleaning only looks at the sales (see clean.clean_multivente), so this 
+    mask can be applied chunk by chunk while the raw data is read (see utils.common.read_data) 
+    without changing the cleaned data. The other conditions of mask_bien cannot: the other 
+    rows of a sale (dependencies, ungeolocated rows...) decide whether it is a multivente.
+
+    Args:
+        df (pandas.DataFrame): DataFrame containing property transaction data.
+
+    Returns:
+        pandas.Series: Boolean mask aligned on the index of 'df'.
+    """
+    return df['nature_mutation'] == 'Vente'
+
+
+def mask_bien(df):
+    """
+    Return the mask of the property transactions that are of type 'Vente', are either 
+    'Maison' or 'Appartement', and have known latitude and longitude values.
+
+    Args:
+        df (pandas.DataFrame): DataFrame containing property transaction data.
+
+    Returns:
+        pandas.Series: Boolean mask aligned on the index of 'df'.
+    """
+    return (mask_vente(df)
+            & df['type_local'].isin(TYPES_BIEN)
+            # our analysis heavily relies on property location
+            & df['latitude'].notna() & df['longitude'].notna())
 
 
 def select_bien(df):  
@@ -28,13 +78,8 @@ def select_bien(df):
     try:
         print("Filtering property types...")
 
-        # Filter by transacation type
-        df = df[df['nature_mutation'] == 'Vente']
-        # Filter by property type. Keep only the 'Maison' and 'Appartement' properties
-        df = df.loc[df['type_local'].isin(['Maison', 'Appartement'])]
-        # Keep only properties with known locations
-        # our analysis heavily relies on property location
-        df = df[(df['latitude'].notna()) & (df['longitude'].notna())]
+        # Keep only the 'Maison' and 'Appartement' sales with known locations
+        df = df[mask_bien(df)]
 
         return df
 
@@ -45,46 +90,170 @@ def select_bien(df):
         print(f"TypeError: {te}")
         return None
 
-def filtre_dur(df, bati, piece, local, metropole_name=None):
+def filtre_dur(df, seuils, piece=None, local=None, metropole_name=None):
     """
-    Filter out outlier values for a given metropolitan area and property type.
+    Filter out outlier values of building surface and number of rooms, for every property 
+    type and metropolitan area at once.
+
+    The thresholds are given as a table mapping a property type, or a (metropole, property type) 
+    pair, to a (maximum surface, maximum number of rooms) pair, e.g.
+    {'Maison': (360, 10), 'Appartement': (200, 6), ('Métropole du Grand Paris', 'Appartement'): (150, 5)}.
+    A (metropole, property type) entry overrides the property type entry in that metropole. Rows 
+    of a property type without thresholds are kept. The constraints are applied in a single 
+    masked pass, and the rows keep their order.
+
+    The former signature filtre_dur(df, bati, piece, local, metropole_name=None) is still accepted.
 
     Args:
         df (pd.DataFrame): Input dataset.
-        bati (int): Maximum allowed building surface.
-        piece (int): Maximum allowed number of rooms.
-        local (str): Type of property ('Maison' or 'Appartement').
-        metropole_name (str, optional): Name of the metropolitan area to be filtered.
+        seuils (dict or int): The threshold table, or the maximum allowed building surface.
+        piece (int, optional): Maximum allowed number of rooms, when 'seuils' is a surface.
+        local (str, optional): Type of property ('Maison' or 'Appartement'), when 'seuils' is a surface.
+        metropole_name (str, optional): Name of the metropolitan area to be filtered, when 'seuils' 
+        is a surface.
 
     Returns:
         pd.DataFrame: The filtered dataset.    
     """
     try:
-        # Filter data for the given local in metropole
-        if metropole_name:
-            print(f"Filtering data for '{local}' in '{metropole_name}'...")
+        if not isinstance(seuils, dict):
+            seuils = {(metropole_name, local) if metropole_name else local: (seuils, piece)}
+        print(f"Filtering data for {', '.join(map(repr, seuils))}...")
 
-            df_metropole = df[(df['type_local'] == local) & (df['LIBEPCI'] == metropole_name)]
-            df_other_metropoles = df[(df['LIBEPCI'] != metropole_name) | ((df['LIBEPCI'] == metropole_name) & (df['type_local'] != local))]
-        else:
-            # Filter data for the given local across all metropoles
-            print(f"Filtering data for '{local}'")
-            df_metropole = df[df['type_local'] == local]
-            df_other_metropoles = df[df['type_local'] != local]
+        # Lay the thresholds out in a (metropole, type) table. The last row and column hold the
+        # rows whose metropole or type has no specific entry (position -1)
+        types = pd.Index(dict.fromkeys(key[1] if isinstance(key, tuple) else key for key in seuils))
+        metropoles = pd.Index(dict.fromkeys(key[0] for key in seuils if isinstance(key, tuple)))
+        limits = np.full((len(metropoles) + 1, len(types) + 1, 2), np.inf)
+        limited = np.zeros((len(metropoles) + 1, len(types) + 1), dtype=bool)
+        for key in sorted(seuils, key=lambda key: isinstance(key, tuple)):
+            if isinstance(key, tuple):
+                rows, col = metropoles.get_loc(key[0]), types.get_loc(key[1])
+            else:
+                rows, col = slice(None), types.get_loc(key)
+            limits[rows, col] = seuils[key]
+            limited[rows, col] = True
 
-        # Filter data based on given 'bati' and 'piece' constraints
-        df_metropole = df_metropole[(df_metropole['surface_reelle_bati'] <= bati) &
-                                    (df_metropole['nombre_pieces_principales'] <= piece)]
+        type_pos = get_positions(types, df['type_local'])
+        if len(metropoles):
+            metropole_pos = get_positions(metropoles, df['LIBEPCI'])
+        else:
+            metropole_pos = np.full(len(df), -1)
+        row_limits = limits[metropole_pos, type_pos]
 
-        # merge filtered data for the given local in metropole with data for other metropoles
-        filtered_df = pd.concat([df_metropole, df_other_metropoles])
+        mask = ~limited[metropole_pos, type_pos] | (
+            (df['surface_reelle_bati'].to_numpy() <= row_limits[:, 0])
+            & (df['nombre_pieces_principales'].to_numpy() <= row_limits[:, 1]))
 
-        return filtered_df    
+        return df[mask]
     except Exception as e:
         print(f"Error occurred in filtre_dur(): {str(e)}")
         return None
 
-def filtre_prix(df, metric_prix, quantile_nv = 0.99):
+def grouped_quantile(values, codes, quantile_nv):
+    """
+    Compute a quantile of 'values' for each group, in a single sort.
+
+    The quantiles are interpolated linearly between the closest ranks, as np.quantile does.
+
+    Args:
+        values (np.ndarray): The values.
+        codes (np.ndarray): The group of each value, from 0 to the number of groups - 1. 
+        Values of group -1 are ignored.
+        quantile_nv (float): The quantile to compute.
+
+    Returns:
+        np.ndarray: The quantile of each group.
+    """
+    valid = codes >= 0
+    values, codes = values[valid].astype('float64'), codes[valid]
+    order = np.lexsort((values, codes))
+    values = values[order]
+
+    sizes = np.bincount(codes, minlength=codes.max() + 1 if len(codes) else 0)
+    starts = np.cumsum(sizes) - sizes
+    rank = (sizes - 1) * quantile_nv
+    lower = np.floor(rank).astype('int64')
+    upper = np.minimum(lower + 1, sizes - 1)
+
+    quantiles = np.full(len(sizes), np.nan)
+    present = sizes > 0
+    low = values[(starts + lower)[present]]
+    high = values[(starts + upper)[present]]
+    quantiles[present] = low + (high - low) * (rank - lower)[present]
+    return quantiles
+
+
+def quantile_sketch(df, metric_prix):
+    """
+    Summarize the prices of each city and property type as a histogram over fixed bins of 
+    PRIX_BIN_WIDTH euros between PRIX_MIN and PRIX_MAX.
+
+    Sketches of different chunks of data can be combined with merge_sketches, so that the 
+    quantiles of filtre_prix can be computed over data that is read by chunks.
+
+    Args:
+        df (pd.DataFrame): Input dataset.
+        metric_prix (str): Name of the column with the price data.
+
+    Returns:
+        pd.Series: The number of prices by city, property type and bin.
+    """
+    df = df[(df[metric_prix] >= PRIX_MIN) & (df[metric_prix] <= PRIX_MAX)]
+    bins = ((df[metric_prix].to_numpy() - PRIX_MIN) // PRIX_BIN_WIDTH).astype('int32')
+    return (df.groupby(['nom_commune', 'type_local', bins], observed=True).size()
+            .rename_axis(['nom_commune', 'type_local', 'bin']))
+
+
+def merge_sketches(sketches):
+    """
+    Combine the sketches of several chunks of data (see quantile_sketch).
+    """
+    sketches = list(sketches)
+    for sketch in sketches:
+        # Group on the category values, whatever the categories of each chunk
+        sketch.index = pd.MultiIndex.from_arrays(
+            [np.asarray(sketch.index.get_level_values(level)) for level in range(3)],
+            names=sketch.index.names)
+    return pd.concat(sketches).groupby(level=[0, 1, 2]).sum()
+
+
+def sketch_quantiles(sketch, quantile_nv):
+    """
+    Approximate a quantile of the prices of each city and property type from a sketch 
+    (see quantile_sketch). The prices are assumed to be uniformly spread in their bin, so 
+    that the error is below PRIX_BIN_WIDTH euros.
+
+    Args:
+        sketch (pd.Series): The number of prices by city, property type and bin.
+        quantile_nv (float): The quantile to compute.
+
+    Returns:
+        pd.Series: The quantile of each city and property type.
+    """
+    sketch = sketch[sketch > 0].sort_index()
+    groups = sketch.index.droplevel('bin')
+    counts = sketch.to_numpy()
+    cumulated = sketch.groupby(level=[0, 1], sort=False).cumsum().to_numpy()
+    sizes = sketch.groupby(level=[0, 1], sort=False).transform('sum').to_numpy()
+
+    # Locate the two prices surrounding the rank of the quantile in their bins, and interpolate
+    # between them as np.quantile does
+    rank = (sizes - 1) * quantile_nv
+    lower = np.floor(rank)
+    upper = np.minimum(lower + 1, sizes - 1)
+    before = cumulated - counts
+    bins = sketch.index.get_level_values('bin').to_numpy()
+    values = []
+    for order in (lower, upper):
+        in_bin = (before <= order) & (order < cumulated)
+        values.append(PRIX_MIN + PRIX_BIN_WIDTH * (bins + (order - before + 0.5) / counts)[in_bin])
+    in_bin = (before <= lower) & (lower < cumulated)
+    quantiles = values[0] + (values[1] - values[0]) * (rank - lower)[in_bin]
+    return pd.Series(quantiles, index=groups[in_bin], name='quantile_prix')
+
+
+def filtre_prix(df, metric_prix, quantile_nv = 0.99, sketch=None):
     """ 
     Compute the 99th percentile for each city (more precise than EPCI) and property 
     type (Appartement, Maison).Filter properties based on their price per square meter 
@@ -92,10 +261,16 @@ def filtre_prix(df, metric_prix, quantile_nv = 0.99):
 
     ++++++ Be careful to use the discounted price ++++++
 
+    The percentiles are computed for all groups at once (see grouped_quantile), and broadcast 
+    to the rows through their group number. When the data is processed by chunks, a sketch 
+    of the whole data (see quantile_sketch and merge_sketches) can be given instead, and the 
+    approximate percentiles of the sketch are used.
+
     Args:
         df (pd.DataFrame): Input dataset.
         metric_prix (str): Name of the column with the price data.
         quantile_nv (float, optional): The quantile value to compute (default is 0.99).
+        sketch (pd.Series, optional): A sketch of the prices of the whole data.
 
     Returns:
         pd.DataFrame: The filtered dataset.
@@ -106,18 +281,21 @@ def filtre_prix(df, metric_prix, quantile_nv = 0.99):
 
         # Remove properties with prices below 1000 euros per square meter or above 20000 euros 
         #per square meter
-        df = df[(df[metric_prix] >= 1000) & (df[metric_prix] <= 20000)]
+        df = df[(df[metric_prix] >= PRIX_MIN) & (df[metric_prix] <= PRIX_MAX)].reset_index(drop=True)
 
         # Compute the 99th percentile for each city and property type
-        quantile_per_city_type = (
-                df.groupby(['nom_commune', 'type_local'])
-                .agg({metric_prix: lambda x: np.quantile(x, quantile_nv)})
-                .reset_index()
-                .rename(columns={metric_prix: 'quantile_prix'})
-            )
-
-        # Merge the 99th percentile values with the original DataFrame
-        df = df.merge(quantile_per_city_type, on=['nom_commune', 'type_local'], how='left')
+        if sketch is None:
+            codes = (df.groupby(['nom_commune', 'type_local'], observed=True, sort=False).ngroup()
+                     .fillna(-1).to_numpy('int64'))
+            quantiles = grouped_quantile(df[metric_prix].to_numpy(), codes, quantile_nv)
+        else:
+            quantiles = sketch_quantiles(sketch, quantile_nv)
+            keys = pd.MultiIndex.from_arrays([np.asarray(df['nom_commune']), np.asarray(df['type_local'])])
+            codes = quantiles.index.get_indexer(keys)
+            quantiles = quantiles.to_numpy()
+
+        # Broadcast the 99th percentile values to the rows of their group
+        df['quantile_prix'] = np.where(codes >= 0, quantiles[codes], np.nan)
         # Filter out properties with prices per square meter above the 99th percentile
         filterd_df = df[df[metric_prix] < df['quantile_prix']]
 
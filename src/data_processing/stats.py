@@ -2,6 +2,7 @@
 
 import pandas as pd
 import matplotlib.pyplot as plt
+from utils.common import drop_duplicate_rows
 
 def stat_sur_filtre(data):
     """
@@ -22,8 +23,8 @@ def stat_sur_filtre(data):
 
     print(f"Data shape: {data.shape}")
     print("Group sizes by LIBEPCI:")
-    print(data.groupby(['LIBEPCI']).size())
-    return data.groupby(['LIBEPCI', 'type_local']).size()
+    print(data.groupby(['LIBEPCI'], observed=True).size())
+    return data.groupby(['LIBEPCI', 'type_local'], observed=True).size()
 
 
 def stat_before_after(data, clean_data):
@@ -50,7 +51,7 @@ def stat_before_after(data, clean_data):
 
     try:
         # Remove duplicates from the original data
-        data.drop_duplicates(inplace=True)
+        data = drop_duplicate_rows(data)
 
         # Filter the data to keep only sales of apartments or houses
         mask = (data.nature_mutation == "Vente") & ((data.type_local == "Appartement") | (data.type_local == "Maison"))
@@ -2,29 +2,64 @@
 Module for processing data related to real estate transactions.
 
 This module provides utility functions for reading and processing geographical data on 
-schools and property transactions. It relies on several libraries, including pandas, geopandas, and scikit-learn.
+schools and property transactions. It relies on several libraries, including pandas, pyproj, scipy and scikit-learn.
 
 Functions:
 - read_lycees(): Read lycees and colleges CSV files and return them as pandas dataframes.
-- get_top_zones(df, nb_top_zones): Returns a new DataFrame containing only the top 'nb_top_zones' 
+- read_metropoles(): Read the table of the communes of each metropole.
+- get_top_zones(df, nb_top_zones, metropoles=None, commune_counts=None): Returns a new DataFrame containing only the top 'nb_top_zones' 
 metropoles with the highest number of real estate transactions.
-- get_k_nearest_neighbors(source_points, candidate_points, k_neighbors): Find the k nearest neighbors 
-for all source points from a set of candidate points.
-- get_nearest_neighbors(left_gdf, right_gdf, k_neighbors, return_distances=False): For each point in left_gdf, 
-find the k-nearest neighbors in right_gdf and return their indices.
+- project_points(lon, lat): Project WGS84 coordinates to Lambert-93.
+- get_k_nearest_neighbors(source_points, candidate_points, k_neighbors, engine='haversine'): Find the k nearest 
+neighbors for all source points from a set of candidate points, with a haversine BallTree or a planar KD-tree.
+- get_coordinates(df): Return the WGS84 coordinates of the points of a dataframe as float64 arrays.
+- get_nearest_neighbors(left_gdf, right_gdf, k_neighbors, return_distances=False, engine=NEIGHBOR_ENGINE): For each 
+point in left_gdf, find the k-nearest neighbors in right_gdf and return their indices.
+- apply_linear_regression(table_info, indices, metric_of_interest, features=REGRESSION_FEATURES, return_slopes=False): 
+Fit the local regressions of a metric over the neighbours of every point at once.
+- idw_mean(neighbors, distances, power=IDW_POWER): Inverse distance weighted mean of the values of the neighbours.
+- aggregate_neighbors(values, indices, reduction='mean', distances=None): Reduce the values of the neighbours of each point.
+- calculate_neighbor_features(dvf, table_info, specs, engine=NEIGHBOR_ENGINE, return_indices=False): Compute several 
+neighbour features with a single tree query at the largest k.
+- compute_by_location(df, func, **kwargs): Compute features that only depend on the location once per distinct 
+location, and broadcast them back to the rows.
 
 """
 import os
 import glob
+from functools import partial
 import warnings
 warnings.filterwarnings('ignore')
 
-from joblib import Parallel, delayed
-import geopandas as gpd
+from pyproj import Transformer
+from scipy.spatial import cKDTree
 from sklearn.neighbors import BallTree
-from sklearn.linear_model import LinearRegression
 import pandas as pd
 import numpy as np
+from utils.common import cached_read, map_categories, unique_coordinates
+
+
+# Communes of each metropole
+METROPOLES_PATH = 'data/open_data/metropoles_communes.csv'
+# Schools tables
+GEO_ETAB_PATH = 'data/open_data/geo_brevet.csv'
+BREVET_PATH = 'data/open_data/resultats_brevet.csv'
+LYCEES_PATH = 'data/open_data/resultats_lycées.csv'
+
+# Nearest neighbour search engines (see get_k_nearest_neighbors), and the one used by default
+NEIGHBOR_ENGINES = ['kdtree', 'haversine']
+NEIGHBOR_ENGINE = 'kdtree'
+WGS84 = 'EPSG:4326'
+LAMBERT_93 = 'EPSG:2154'
+
+# Reductions of the values of the neighbours of a point (see aggregate_neighbors)
+NEIGHBOR_REDUCTIONS = {'mean': np.nanmean, 'median': np.nanmedian, 'std': partial(np.nanstd, ddof=1),
+                       'min': np.nanmin, 'max': np.nanmax, 'sum': np.nansum}
+# Power of the distances in the inverse distance weighted mean (see idw_mean)
+IDW_POWER = 2
+
+# Explanatory variables of the local regressions (see apply_linear_regression)
+REGRESSION_FEATURES = ['surface_reelle_bati', 'nombre_pieces_principales']
 
 
 def read_lycees():
@@ -39,11 +74,11 @@ def read_lycees():
     try:
         print("Reading lycees tables...")
         # read geographical coordinates of schools
-        geo_etab_df = pd.read_csv('data/open_data/geo_brevet.csv', delimiter=';')
+        geo_etab_df = cached_read(GEO_ETAB_PATH, pd.read_csv, delimiter=';')
         # read results at brevet for each college
-        brevet_df = pd.read_csv('data/open_data/resultats_brevet.csv', delimiter=';')
+        brevet_df = cached_read(BREVET_PATH, pd.read_csv, delimiter=';')
         # read results at 'baccalaureat' for each lycee
-        lyc_df = pd.read_csv('data/open_data/resultats_lycées.csv', sep=';')
+        lyc_df = cached_read(LYCEES_PATH, pd.read_csv, sep=';')
 
         return geo_etab_df, brevet_df, lyc_df
 
@@ -54,7 +89,21 @@ def read_lycees():
         print(f"An error occurred while reading lycees tables: {e}")
         return None        
 
-def get_top_zones(df, nb_top_zones):
+def read_metropoles():
+    """
+    Read the table of the communes of each metropole.
+
+    Returns:
+        pandas.DataFrame: The metropole ('LIBEPCI') of each commune ('LIBGEO').
+    """
+    try:
+        print("Reading metropoles table...")
+        return cached_read(METROPOLES_PATH, pd.read_csv, delimiter=';', header=5)
+    except Exception as e:
+        print(f"An error occurred while reading metropoles table: {e}")
+        return None
+
+def get_top_zones(df, nb_top_zones, metropoles=None, commune_counts=None):
 
     """
     Returns a new DataFrame containing only the top 'nb_top_zones' metropoles 
@@ -63,29 +112,54 @@ def get_top_zones(df, nb_top_zones):
     Args:
         df (pandas.DataFrame): The input DataFrame.
         nb_top_zones (int): The number of top metropoles to select.
+        metropoles (pandas.DataFrame, optional): The table of the communes of each metropole, 
+        if already loaded (see read_metropoles).
+        commune_counts (pandas.Series, optional): The number of transactions of each commune 
+        to rank the metropoles on, e.g. counted on the raw data while it is read, when 'df' 
+        only holds part of the transactions. Defaults to the rows of 'df'.
 
     Returns:
         pandas.DataFrame: A new DataFrame containing only the top 'nb_top_zones' metropoles 
         with the highest number of real estate transactions.
     """
-    # Import tables import numpy as np
-    path_to_metropoles = 'data/open_data/metropoles_communes.csv'
     try:
 
         print('Selecting top 10 metropoles...')
-        metropoles = pd.read_csv(path_to_metropoles, delimiter=';', header=5)
+        if metropoles is None:
+            metropoles = read_metropoles()
 
         # Correct the spelling of regions
-        df.loc[df.nom_commune.str.startswith('Marseille '), 'nom_commune'] = 'Marseille'
-        df.loc[df.nom_commune.str.startswith('Lyon '), 'nom_commune'] = 'Lyon'
-        df.loc[df.nom_commune.str.startswith('Paris '), 'nom_commune'] = 'Paris'
-
-        # Merge dvf and metropole
+        def merge_arrondissements(names):
+            for city in ['Marseille', 'Lyon', 'Paris']:
+                names = names.mask(names.str.startswith(city + ' '), city)
+            return names
+        df['nom_commune'] = map_categories(df['nom_commune'], merge_arrondissements)
+
+        if commune_counts is not None:
+            # Rank the metropoles on the given counts, before the names of the communes 
+            # are restricted to the ones of df
+            commune_counts = commune_counts[commune_counts.index.notna()]
+            zones = pd.DataFrame({'LIBGEO': merge_arrondissements(
+                                      commune_counts.index.to_series().astype(str)).to_numpy(),
+                                  'count': commune_counts.to_numpy()})
+            communes = metropoles.dropna(subset=['LIBGEO'])[['LIBGEO', 'LIBEPCI']].astype({'LIBGEO': str})
+            zones = zones.merge(communes, on='LIBGEO')
+            zone_counts = zones.groupby('LIBEPCI')['count'].sum().sort_values(ascending=False)
+
+        # Merge dvf and metropole, on keys sharing the same categories. The communes of the 
+        # metropoles missing from dvf are dropped first: as categories, they would be missing 
+        # keys, matching the rows of dvf without commune
+        categories = df['nom_commune'].cat.categories
+        metropoles = metropoles.loc[metropoles['LIBGEO'].isin(categories)]
+        metropoles = metropoles.assign(LIBGEO=pd.Categorical(metropoles['LIBGEO'], categories=categories))
         df = df.merge(metropoles, how='left', left_on='nom_commune', right_on='LIBGEO')
 
         # Pick the areas with the highest number of transactions
-        most_frequent = df['LIBEPCI'].value_counts().head(nb_top_zones).index.to_list()
+        if commune_counts is None:
+            zone_counts = df['LIBEPCI'].value_counts()
+        most_frequent = zone_counts.head(nb_top_zones).index.to_list()
         df = df.loc[df['LIBEPCI'].isin(most_frequent)]
+        df['LIBEPCI'] = df['LIBEPCI'].astype('category')
 
         return df
 
@@ -93,7 +167,23 @@ def get_top_zones(df, nb_top_zones):
         print(f"An error occurred while selecting the top {nb_top_zones} zones: {str(e)}")
         return None
 
-def get_k_nearest_neighbors(source_points, candidate_points, k_neighbors):
+def project_points(lon, lat):
+    """
+    Project WGS84 coordinates to Lambert-93, the planar projection of metropolitan France.
+
+    Args:
+        lon (array-like): The longitudes, in degrees.
+        lat (array-like): The latitudes, in degrees.
+
+    Returns:
+        np.ndarray: The (x, y) coordinates in meters, one row per point.
+    """
+    transformer = Transformer.from_crs(WGS84, LAMBERT_93, always_xy=True)
+    return np.column_stack(transformer.transform(np.asarray(lon, dtype='float64'),
+                                                 np.asarray(lat, dtype='float64')))
+
+
+def get_k_nearest_neighbors(source_points, candidate_points, k_neighbors, engine='haversine'):
     """
     Find the k nearest neighbors for all source points from a set of candidate points.
     
@@ -101,6 +191,8 @@ def get_k_nearest_neighbors(source_points, candidate_points, k_neighbors):
         source_points: numpy array or list of arrays containing the coordinates of the source points
         candidate_points: numpy array or list of arrays containing the coordinates of the candidate points
         k_neighbors: integer specifying the number of nearest neighbors to return
+        engine: 'haversine' for (latitude, longitude) coordinates in radians, searched with a 
+        BallTree, or 'kdtree' for planar coordinates, searched with a KD-tree on all cores
     
     Returns:
         tuple containing two numpy arrays:
@@ -108,69 +200,233 @@ def get_k_nearest_neighbors(source_points, candidate_points, k_neighbors):
         - distances: the distances between each source point and its k nearest neighbors
     """
     try:
-        tree = BallTree(candidate_points, leaf_size=15, metric='haversine')
-        distances, indices = tree.query(source_points, k=k_neighbors)
+        if engine == 'kdtree':
+            tree = cKDTree(candidate_points)
+            distances, indices = tree.query(source_points, k=k_neighbors, workers=-1)
+            if k_neighbors == 1:
+                distances, indices = distances[:, None], indices[:, None]
+        elif engine == 'haversine':
+            tree = BallTree(candidate_points, leaf_size=15, metric='haversine')
+            distances, indices = tree.query(source_points, k=k_neighbors)
+        else:
+            raise ValueError(f"Invalid engine '{engine}'. Choose one of {NEIGHBOR_ENGINES}.")
         return indices, distances
     except Exception as e:
         print(f"An error occurred: {e}")
         return None, None
 
 
-def get_nearest_neighbors(left_gdf, right_gdf, k_neighbors, return_distances=False):
+def get_coordinates(df):
     """
-    For each point in left_gdf, find the k-nearest neighbors in right_gdf and return their indices.
-    Assumes that the input Points are in WGS84 projection (lat/lon).
+    Return the WGS84 coordinates of the points of a dataframe as contiguous float64 arrays, from its 
+    'longitude' and 'latitude' columns if it has them, or else from its point geometries.
+
+    Args:
+        df (pd.DataFrame or gpd.GeoDataFrame): The points.
+
+    Returns:
+        tuple: The longitudes and the latitudes, in degrees.
     """
-    left_geom_col_name = left_gdf.geometry.name
-    right_geom_col_name = right_gdf.geometry.name
+    if 'longitude' in df.columns and 'latitude' in df.columns:
+        return (np.ascontiguousarray(df['longitude'], dtype='float64'),
+                np.ascontiguousarray(df['latitude'], dtype='float64'))
+    return (np.ascontiguousarray(df.geometry.x, dtype='float64'),
+            np.ascontiguousarray(df.geometry.y, dtype='float64'))
 
-    #ensure that index in right gdf is formed of sequential numbers
-    right_gdf = right_gdf.reset_index(drop=True)
 
-    # convert coordinates to radians
-    left_radians_x = left_gdf[left_geom_col_name].x.apply(lambda geom: geom * np.pi / 180)
-    left_radians_y = left_gdf[left_geom_col_name].y.apply(lambda geom: geom * np.pi / 180)
-    left_radians = np.c_[left_radians_x, left_radians_y]
+def get_nearest_neighbors(left_gdf, right_gdf, k_neighbors, return_distances=False, engine=NEIGHBOR_ENGINE):
+    """
+    For each point in left_gdf, find the k-nearest neighbors in right_gdf and return their indices.
+    Assumes that the input Points are in WGS84 projection (lat/lon). The points are read from 
+    'longitude' and 'latitude' columns when present (see get_coordinates), so that no geometry 
+    is needed.
 
-    right_radians_x = right_gdf[right_geom_col_name].x.apply(lambda geom: geom * np.pi / 180)
-    right_radians_y = right_gdf[right_geom_col_name].y.apply(lambda geom: geom * np.pi / 180)
-    right_radians = np.c_[right_radians_x, right_radians_y]
+    With the 'kdtree' engine, the points are projected to Lambert-93 and the distances are in 
+    meters. With the 'haversine' engine, the distances are in radians.
+    """
+    left_lon, left_lat = get_coordinates(left_gdf)
+    right_lon, right_lat = get_coordinates(right_gdf)
 
-    indices, distances = get_k_nearest_neighbors(source_points=left_radians,
-                                                 candidate_points=right_radians,
-                                                 k_neighbors=k_neighbors)
+    if engine == 'kdtree':
+        left_points = project_points(left_lon, left_lat)
+        right_points = project_points(right_lon, right_lat)
+    else:
+        # convert coordinates to radians, latitude first as expected by the haversine metric
+        left_points = np.radians(np.column_stack([left_lat, left_lon]))
+        right_points = np.radians(np.column_stack([right_lat, right_lon]))
+
+    indices, distances = get_k_nearest_neighbors(source_points=left_points,
+                                                 candidate_points=right_points,
+                                                 k_neighbors=k_neighbors,
+                                                 engine=engine)
     if return_distances:
         return indices, distances
     else:
         return indices
 
 
-def apply_linear_regression(row,table_info, metric_of_interest):
+def apply_linear_regression(table_info, indices, metric_of_interest, features=REGRESSION_FEATURES, return_slopes=False):
+    """
+    Fit the linear regression of the metric of interest on 'features' over the neighbours of every 
+    point at once, and return the intercepts.
+
+    The (n, k, p) design tensor of the neighbours is built in a single gather, and the n centered 
+    least-squares problems are solved together through stacked pseudo-inverses. This gives the 
+    minimum-norm solution, like sklearn's LinearRegression. Points with a missing value among 
+    their neighbours get NaN.
 
-    """Apply linear regression to calculate the intercept of a row with the given metric of interest."""
-    indices = row['indices']
-    X = table_info.loc[indices, ['surface_reelle_bati', 'nombre_pieces_principales']].values
-    y = table_info.loc[indices, metric_of_interest].values
+    Args:
+        table_info (pd.DataFrame): The candidate points.
+        indices (np.ndarray): The (n, k) positions of the neighbours of each point in table_info.
+        metric_of_interest (str): The column to regress.
+        features (list, optional): The explanatory columns.
+        return_slopes (bool, optional): Whether to return the (n, p) slopes as well.
+
+    Returns:
+        np.ndarray: The intercept for each point, and the slopes if 'return_slopes' is True.
+    """
+    X = np.append(table_info[features].to_numpy(dtype='float64'), np.full((1, len(features)), np.nan), axis=0)
+    y = np.append(table_info[metric_of_interest].to_numpy(dtype='float64'), np.nan)
+    # Out of range positions (missing neighbours) point to the last, missing, row
+    indices = np.minimum(indices, len(y) - 1)
+    X, y = X[indices], y[indices]
+
+    intercepts = np.full(len(indices), np.nan)
+    slopes = np.full((len(indices), len(features)), np.nan)
+    valid = np.isfinite(X).all(axis=(1, 2)) & np.isfinite(y).all(axis=1)
+    if valid.any():
+        X, y = X[valid], y[valid]
+        X_mean, y_mean = X.mean(axis=1), y.mean(axis=1)
+        X_centered = X - X_mean[:, None, :]
+        y_centered = y - y_mean[:, None]
+        coefs = np.matmul(np.linalg.pinv(X_centered), y_centered[:, :, None])[:, :, 0]
+        slopes[valid] = coefs
+        intercepts[valid] = y_mean - np.einsum('ij,ij->i', X_mean, coefs)
+
+    if return_slopes:
+        return intercepts, slopes
+    return intercepts
+
+
+def idw_mean(neighbors, distances, power=IDW_POWER):
+    """
+    Average the values of the neighbours of each point, weighted by the inverse of their distance 
+    to the point raised to 'power'. Neighbours at a null distance take all the weight.
 
-    lr = LinearRegression()
-    lr.fit(X, y)
+    Args:
+        neighbors (np.ndarray): The (n, k) values of the neighbours. Missing values are skipped.
+        distances (np.ndarray): The (n, k) distances of the neighbours.
+        power (float, optional): The power of the distances.
 
-    return lr.intercept_
+    Returns:
+        np.ndarray: The weighted mean for each point.
+    """
+    known = ~np.isnan(neighbors)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(known, 1 / distances ** power, 0)
+        # Points with neighbours at their own location get the mean of these neighbours
+        exact = known & (distances == 0)
+        has_exact = exact.any(axis=1)
+        weights[has_exact] = exact[has_exact]
+        return (weights * np.where(known, neighbors, 0)).sum(axis=1) / weights.sum(axis=1)
 
 
-def calculate_closest_metric(dvf, table_info, k_neighbors, metric_of_interest, new_metric_name, apply_regression=False):
-    """Compute the new metric based on the k-nearest neighbors in table_info dataframe."""
+def aggregate_neighbors(values, indices, reduction='mean', distances=None):
+    """
+    Reduce the values of the neighbours of each point, in a single gather.
+
+    Args:
+        values (array-like): The values of the candidate points.
+        indices (np.ndarray): The (n, k) positions of the neighbours of each point in 'values'. 
+        Positions out of range (missing neighbours) count as missing values.
+        reduction (str, optional): The reduction, one of NEIGHBOR_REDUCTIONS or 'idw_mean' (see idw_mean). 
+        Missing values are skipped, as pandas does.
+        distances (np.ndarray, optional): The (n, k) distances of the neighbours, required by 'idw_mean'.
+
+    Returns:
+        np.ndarray: The reduced value for each point, NaN when all its neighbours are missing.
+    """
+    values = np.append(np.asarray(values, dtype='float64'), np.nan)
+    neighbors = values[np.minimum(indices, len(values) - 1)]
+    with warnings.catch_warnings():
+        # Points without any known neighbour value are expected to be NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        if reduction == 'idw_mean':
+            if distances is None:
+                raise ValueError("The 'idw_mean' reduction requires the distances of the neighbours.")
+            return idw_mean(neighbors, distances)
+        return NEIGHBOR_REDUCTIONS[reduction](neighbors, axis=1)
+
+
+def calculate_neighbor_features(dvf, table_info, specs, engine=NEIGHBOR_ENGINE, return_indices=False):
+    """
+    Compute several features from the k-nearest neighbors in table_info dataframe, with a single 
+    tree build and a single query at the largest k.
+
+    Args:
+        dvf (gpd.GeoDataFrame): The points to compute the features for.
+        table_info (gpd.GeoDataFrame): The candidate points.
+        specs (list): The features, as (k, column, statistic) or (k, column, statistic, name) tuples. 
+        The statistic is one of NEIGHBOR_REDUCTIONS or 'idw_mean' (see idw_mean). The default name is 
+        '<column>_<statistic>_<k>'.
+        engine (str, optional): The nearest neighbour engine (see get_k_nearest_neighbors).
+        return_indices (bool, optional): Whether to return the (n, k) int32 matrix of the positions 
+        of the neighbours in table_info as well.
+
+    Returns:
+        gpd.GeoDataFrame: 'dvf' with a column per feature.
+    """
+    try:
+        specs = [spec if len(spec) == 4 else (*spec, f'{spec[1]}_{spec[2]}_{spec[0]}') for spec in specs]
+        print(f"Computing {', '.join(f'`{spec[3]}`' for spec in specs)}...")
+        k_max = max(spec[0] for spec in specs)
+        closest_indices, distances = get_nearest_neighbors(left_gdf=dvf, right_gdf=table_info, k_neighbors=k_max,
+                                                           return_distances=True, engine=engine)
+        closest_indices = closest_indices.astype('int32')
+
+        # The neighbours are sorted by distance, so the k nearest are the first k of the query
+        for k_neighbors, column, statistic, name in specs:
+            dvf[name] = aggregate_neighbors(table_info[column], closest_indices[:, :k_neighbors], statistic,
+                                            distances[:, :k_neighbors])
+
+        if return_indices:
+            return dvf, closest_indices
+        return dvf
+
+    except Exception as e:
+        print("Error: could not calculate neighbor features")
+        print(str(e))
+        return None
+
+
+def calculate_closest_metric(dvf, table_info, k_neighbors, metric_of_interest, new_metric_name, apply_regression=False,
+                             engine=NEIGHBOR_ENGINE, reduction='mean', return_indices=False, return_slopes=False):
+    """
+    Compute the new metric based on the k-nearest neighbors in table_info dataframe (see get_nearest_neighbors).
+
+    The metric of the neighbours is reduced with aggregate_neighbors or, if 'apply_regression' is True, 
+    replaced by the intercept of its regression on the neighbours (see apply_linear_regression). 
+    With 'return_slopes', the slopes of the regression are added as '<new_metric_name>_<feature>' 
+    columns. If 'return_indices' is True, the (n, k) int32 matrix of the positions of the neighbours 
+    in table_info is returned as well.
+    """
     try:
         print(f"Computing `{new_metric_name}`...")
-        dvf[new_metric_name] = np.nan
-        closest_indices = get_nearest_neighbors(left_gdf=dvf, right_gdf=table_info, k_neighbors=k_neighbors)
-        dvf['indices'] = list(closest_indices)
+        closest_indices = get_nearest_neighbors(left_gdf=dvf, right_gdf=table_info, k_neighbors=k_neighbors,
+                                                engine=engine).astype('int32')
 
         if apply_regression: 
-            dvf[new_metric_name] = dvf.swifter.apply(lambda row: apply_linear_regression(row, metric_of_interest), axis=1)
+            intercepts, slopes = apply_linear_regression(table_info, closest_indices, metric_of_interest,
+                                                         return_slopes=True)
+            dvf[new_metric_name] = intercepts
+            if return_slopes:
+                for feature, feature_slopes in zip(REGRESSION_FEATURES, slopes.T):
+                    dvf[f'{new_metric_name}_{feature}'] = feature_slopes
         else:
-            dvf[new_metric_name] = dvf['indices'].apply(lambda indices: table_info[metric_of_interest].iloc[indices].mean())
+            dvf[new_metric_name] = aggregate_neighbors(table_info[metric_of_interest], closest_indices, reduction)
 
+        if return_indices:
+            return dvf, closest_indices
         return dvf
 
     except Exception as e:
@@ -179,41 +435,82 @@ def calculate_closest_metric(dvf, table_info, k_neighbors, metric_of_interest, n
         return None
 
 
-def alter_metric_name(df,input_variable_names,output_variable_names):
+def compute_by_location(df, func, **kwargs):
+    """
+    Compute features that only depend on the location of the rows once per distinct 
+    (longitude, latitude) pair, and broadcast them back to the rows sharing it.
+
+    Transactions in the same building, and the lots of a multi-unit sale, share their coordinates, 
+    so that there are much fewer distinct locations than rows.
+
+    Args:
+        df (pd.DataFrame): A dataframe with 'longitude' and 'latitude' columns, all known.
+        func (callable): A function taking a dataframe of locations as its 'dvf' argument and 
+        returning it with the new feature columns, e.g. calculate_closest_metric.
+        **kwargs: The other arguments of 'func'.
+
+    Returns:
+        pd.DataFrame: 'df' with the new feature columns, or None if 'func' failed.
+    """
+    locations, inverse = unique_coordinates(df)
+    if (inverse < 0).any():
+        raise ValueError("All the rows must have known coordinates.")
+    # 'func' may add the features to the locations in place
+    location_columns = list(locations.columns)
+    located = func(dvf=locations, **kwargs)
+    if located is None:
+        return None
+    for col in located.columns.difference(location_columns, sort=False):
+        df[col] = located[col].to_numpy()[inverse]
+    return df
+
+
+def alter_metric_name(df, input_variable_names, output_variable_names, engine=NEIGHBOR_ENGINE):
     """
-    Calculate new metrics using my_choose_closest() function and return updated dataframe.
+    Calculate new metrics by filling the missing values of the input variables with the value of 
+    the closest row where they are known, and return updated dataframe.
+
+    The input variables are grouped by their mask of known values, which is mostly shared as they 
+    come from the same IRIS rows. Each group takes a single tree build on the distinct locations 
+    knowing its values, and a single query of the distinct locations missing them.
 
     Args:
         df (pandas dataframe): dataframe to calculate new metrics on.
         input_variable_names (list): names of variables to calculate new metrics from.
         output_variable_names (list): names to give new metrics.
+        engine (str, optional): The nearest neighbour engine (see get_k_nearest_neighbors).
 
     Returns:
         df (pandas dataframe): updated dataframe with input variables dropped and new metrics added.
     """
-    # Define a helper function to calculate a single new metric using my_choose_closest() function
-    def calculate_single_metric(params):
-        input_var = params[0]
-        output_var = params[1]
-        return calculate_closest_metric(dvf=df,
-                                        table_info=df[df[input_var].notnull()], 
-                                        k_neighbors=1,
-                                        metric_of_interest=input_var, 
-                                        new_metric_name=output_var)[output_var]
-    
-    # Calculate the new metrics using parallel processing
-    results = Parallel(n_jobs=-1, verbose=1)(
-        delayed(calculate_single_metric)(vars) for vars in zip(input_variable_names, output_variable_names))
-    
-    # Create a dictionary of new metric names and values
-    new_metrics_dict = dict(zip(output_variable_names, results))
-    
-    # Add the new metrics to the df dataframe
-    df = df.assign(**new_metrics_dict)
-    
-    # Drop the input variables from the df dataframe
+    print(f"Computing {len(output_variable_names)} metrics from the closest known values...")
+    known = df[input_variable_names].notnull().to_numpy()
+
+    # Group the variables sharing the same mask of known values
+    groups = {}
+    for position, mask in enumerate(known.T):
+        groups.setdefault(mask.tobytes(), []).append(position)
+
+    new_metrics = df[input_variable_names].copy()
+    new_metrics.columns = output_variable_names
+    for positions in groups.values():
+        mask = known[:, positions[0]]
+        if mask.all() or not mask.any():
+            continue
+        # The values come from the IRIS area of the rows, so that they only depend on the location:
+        # the distinct locations missing them are matched to the distinct locations knowing them
+        missing_rows, known_rows = np.flatnonzero(~mask), np.flatnonzero(mask)
+        missing_locations, inverse = unique_coordinates(df.iloc[missing_rows])
+        known_rows = known_rows[~df.iloc[known_rows].duplicated(subset=['longitude', 'latitude']).to_numpy()]
+        closest_indices = get_nearest_neighbors(left_gdf=missing_locations, right_gdf=df.iloc[known_rows],
+                                                k_neighbors=1, engine=engine)[:, 0]
+        closest_values = new_metrics.iloc[known_rows[closest_indices][inverse], positions]
+        new_metrics.iloc[missing_rows, positions] = closest_values.to_numpy()
+
+    # Add the new metrics to the df dataframe, and drop the input variables
     df = df.drop(columns=input_variable_names)
-    
+    df = df.assign(**{col: new_metrics[col].to_numpy() for col in output_variable_names})
+
     return df
 
 income_input_variable_names = ['DISP_TP6019', 'DISP_Q119', 'DISP_MED19', 'DISP_Q319', 'DISP_EQ19', 'DISP_D119', 'DISP_D219',
@@ -260,8 +557,8 @@ liste_var_garder=['id_mutation', 'date_mutation', 'numero_disposition', 'valeur_
        'lot3_surface_carrez', 'lot4_numero', 'lot4_surface_carrez',
        'lot5_numero', 'lot5_surface_carrez', 'type_local',
        'surface_reelle_bati', 'nombre_pieces_principales', 'surface_terrain',
-       'longitude', 'latitude', 'geometry', 'quantile_prix', 'coeff_actu','prix_actualise','prix_m2_actualise','prix_m2','trimestre_vente','prix_m2_zone',
-        'moyenne','moyenne_brevet','DCOMIRIS','indices', 'Banques', 'Bureaux_de_Poste', 'Commerces', 'Ecoles','Collèges_Lycées', 'Medecins',
+       'longitude', 'latitude', 'quantile_prix', 'coeff_actu','prix_actualise','prix_m2_actualise','prix_m2','trimestre_vente','prix_m2_zone',
+        'moyenne','moyenne_brevet','DCOMIRIS', 'Banques', 'Bureaux_de_Poste', 'Commerces', 'Ecoles','Collèges_Lycées', 'Medecins',
        'Gares', 'Cinema', 'Bibliotheques', 'Espaces_remarquables_et_patrimoine', 'DCIRIS',
        'Taux_pauvreté_seuil_60', 'Q1', 'Mediane', 'Q3', 'Ecart_inter_Q_rapporte_a_la_mediane', 'D1', 'D2', 'D3', 'D4',
        'D5', 'D6', 'D7', 'D8', 'D9', 'Rapport_interdécile_D9/D1', 'S80/S20', 'Gini', 'Part_revenus_activite',
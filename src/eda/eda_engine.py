@@ -1,10 +1,13 @@
 """
 This module provides an engine that utilizes functions for performing exploratory data analysis (EDA) on processed data.
 """
+import os
 import logging
 import traceback
-import geopandas as gpd
-from utils.common import convert_gpd, read_data, read_equi, read_iris, iris_prep
+import pandas as pd
+from utils.common import (
+    assign_iris, convert_gpd, iris_mapping_path, read_data, read_equi, read_iris, iris_prep, read_processed
+    )
 from eda.utilities import ( create_output_dir, modify_geo_data,
     read_communes, select_equi,
     transform_equi, select_variables
@@ -17,7 +20,7 @@ def eda_engine(data_path):
     Performs exploratory data analysis (EDA) on the input data.
 
     Args:
-        data_path (str): The path to the processed data file.
+        data_path (str): The path to the processed dataset directory (or csv file).
 
     Returns:
         bool: True if the EDA is completed successfully, False otherwise.
@@ -26,7 +29,10 @@ def eda_engine(data_path):
     example_area = 'PARIS' #Change to prefered Area
     try:
         # Read processed data
-        data = read_data(data_path)
+        if os.path.isdir(data_path):
+            data = read_processed(data_path)
+        else:
+            data = read_data(data_path)
         print('Ready to start EDA')
         print('****************************')
     except FileNotFoundError:
@@ -64,10 +70,12 @@ def eda_engine(data_path):
 
         ## Add information about the IRIS area
         iris = iris_prep(iris_value, iris_shape)
-        iris['iris_geometry'] = iris.geometry 
+        # Reuse the IRIS areas found by the preprocessing, or the stored mapping of coordinates
+        if 'DCOMIRIS' not in geo_data.columns:
+            geo_data['DCOMIRIS'] = assign_iris(geo_data, iris_shape, iris_mapping_path())
+        geo_data['DCOMIRIS'] = geo_data['DCOMIRIS'].astype(object)
         # Join data
-        joined_geo_data = gpd.sjoin(geo_data, iris, how = 'left', op = 'within')
-        filtered_data = joined_geo_data.drop(columns = ['iris_geometry'])
+        filtered_data = geo_data.merge(pd.DataFrame(iris.drop(columns='geometry')), how='left', on='DCOMIRIS')
 
         # Modify tables
         data, iris, commune = modify_geo_data(filtered_data, iris, commune)
@@ -30,32 +30,35 @@ def run_model(params, data):
         return None
 
 
-def ml_engine(path="data/processed/processed_data.csv"):
+def ml_engine(path="data/processed/processed_data"):
     '''
     Run machine learning model benchmark for all metropole, type_local, and model(Linear, xgboost, random).
     It will generate a result.txt, result.csv, and feature importance for ensemble methods.
 
     Args:
         path : str, optional
-            The path to the preprocessed data file
+            The path to the preprocessed dataset (or csv file)
 
     Returns:
         None
     '''
     try:
         print("Reading processed file..")
-        data = read_data(path)
-        metropole = list(data.LIBEPCI.unique())
+        metropole = list(read_data(path, columns=['LIBEPCI']).LIBEPCI.unique())
         type_bien = ["Appartement", 'Maison']
         model = ['linear', 'xgboost', 'random_forest']
         # model=['xgboost']
-        permutation = [(i, j, k) for i in metropole for j in type_bien for k in model]
         results_dataframe = []
-        for p in permutation:
-            print("Running model for ", p)
-            result = run_model(p, data)
-            if result is not None:
-                results_dataframe.append(result)
+        for metro in metropole:
+            for type_local in type_bien:
+                # Only read the slice of the data used by the models
+                data = read_data(path, LIBEPCI=metro, type_local=type_local)
+                for mod in model:
+                    p = (metro, type_local, mod)
+                    print("Running model for ", p)
+                    result = run_model(p, data)
+                    if result is not None:
+                        results_dataframe.append(result)
         print("Saving result dataframe to disk..")
         result = pd.concat(results_dataframe)
         result.to_csv('output/model/results.csv', index=False)
@@ -90,12 +90,13 @@ def preprocess_ml(data, type_local):
         pd.DataFrame: The cleaned dataframe.
     """
     
-    # Drop unnecessary columns
+    # Drop unnecessary columns, and the prices discounted to other quarters
     drop_clean=list(set(data.columns)&set(to_drop))
+    drop_clean+=[col for col in data.columns if col.startswith('prix_m2_actualise_')]
     data  = data.drop(drop_clean, axis=1)
     
     # get numerical columns and calculate correlation matrix
-    numerical_columns = list(data.select_dtypes(exclude=["object","string"]).columns)
+    numerical_columns = list(data.select_dtypes(exclude=["object","string","category"]).columns)
     target='prix_m2_actualise'
     numerical_columns=[col for col in numerical_columns if col!=target]
     corr_matrix = data[numerical_columns].corr().abs()
@@ -124,7 +125,7 @@ def build_pipeline(model,data):
     Returns:
     clf : the resulting pipeline after applying the RandomSearchCV or GridSearchCV
     '''
-    numerical_columns = list(data.select_dtypes(exclude=["object","string"]).columns)
+    numerical_columns = list(data.select_dtypes(exclude=["object","string","category"]).columns)
     target='prix_m2_actualise'
     numerical_columns=[col for col in numerical_columns if col!=target]
     categorical_columns=['code_departement'] 
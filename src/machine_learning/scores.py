@@ -54,7 +54,7 @@ def train_score_save(model, data, metropole, type_local):
         
         shape = data.shape
         estimator = clf.best_estimator_
-        numerical_columns = list(data.select_dtypes(exclude=["object","string"]).columns)
+        numerical_columns = list(data.select_dtypes(exclude=["object","string","category"]).columns)
         target='prix_m2_actualise'
         numerical_columns=[col for col in numerical_columns if col!=target]
         new_cat_cols = estimator.named_steps['preprocessor'].named_transformers_["cat"].named_steps["encoder"].get_feature_names_out(['code_departement'])
@@ -1,6 +1,8 @@
+import os
 import pandas as pd
 import matplotlib.pyplot as plt
 from joblib import dump
+from utils.common import compact_dtypes, read_processed
 
 def save_result(estimator,type_local,model,metropole,best_score,best_params,rmse,score,median,mean,shape):
             '''
@@ -31,9 +33,24 @@ def save_result(estimator,type_local,model,metropole,best_score,best_params,rmse
                 f.write(result + '\n')
             return dataframe
             
-def read_data(path):
+def read_data(path, columns=None, **partition):
+        '''
+        Read the processed data, either the partitioned dataset written by the preprocessing 
+        engine or a csv file.
+        Args:
+        path: str, the dataset directory or csv file
+        columns: list, the columns to read (all if None)
+        partition: the values of 'LIBEPCI' and/or 'type_local' to read
+
+        Return dataframe
+        '''
         try: 
-            df = pd.read_csv(path)
+            if os.path.isdir(path):
+                df = read_processed(path, columns, **partition)
+            else:
+                df = compact_dtypes(pd.read_csv(path, usecols=columns))
+                for col, value in partition.items():
+                    df = df[df[col] == value]
         except IOError as e:
              print(e)
              print('make sure you have generated the processed file first')
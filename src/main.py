@@ -27,7 +27,7 @@ def parse_file_path(path):
         raise FileNotFoundError(f"No such file or directory: '{path}'")
     if os.path.isdir(path):
         # if the path is a directory, return all CSV files in the directory
-        return [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.csv')]
+        return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.csv')]
     if os.path.isfile(path):
         # if the path is a file, return the file path as a list
         return [path]
@@ -41,6 +41,15 @@ def main():
     parser.add_argument('--preprocess', metavar='data_path', nargs='+', type=str,
                         help='path(s) of the raw data file(s) to be preprocessed.'
                         'You can use wildcards such as * to specify multiple files.')
+    parser.add_argument('--jobs', metavar='n_jobs', type=int, default=-1,
+                        help='number of worker processes used to read the raw data files '
+                        'in parallel (default: -1, all cores).')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='rerun every preprocessing stage instead of resuming from the '
+                        'checkpoints of an earlier run.')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true',
+                        help='report the memory allocated during each preprocessing stage '
+                        'with tracemalloc (slower).')
     parser.add_argument('--ml', dest='ml', action='store_true',
                         help='run the machine learning engine')
     parser.add_argument('--eda', metavar='data_path', type=str,
@@ -52,7 +61,8 @@ def main():
         try:
             file_paths = [path for pattern in args.preprocess for path in parse_file_path(pattern)]
             logging.info("Running the pre-processing engine on files: %s", ', '.join(file_paths))
-            if preprocessing_engine(file_paths):
+            if preprocessing_engine(file_paths, n_jobs=args.jobs, resume=args.resume,
+                                    trace_memory=args.trace_memory):
                 logging.info("Pre-processing completed successfully!")
             else:
                 logging.error("Error occurred during pre-processing!")
@@ -1,29 +1,563 @@
 """
 his module provides a collection of frequently used functions for reading and manipulating geographical data, which can be utilized across various modules
 """
+import os
+import json
+import shutil
+import hashlib
+import threading
+from joblib import Parallel, delayed
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
+from pyproj import Transformer
 
 
-def read_data(data_paths):
+# Directory of the columnar copies of the open data tables
+CACHE_DIR = 'data/cache'
+# IRIS tables, and the mappings of coordinates to IRIS areas stored in CACHE_DIR
+IRIS_VALUE_PATH = 'data/open_data/IRIS_donnees.csv'
+IRIS_SHAPE_PATH = 'data/open_data/IRIS_contours.shp'
+IRIS_MAPPING_PREFIX = 'iris_mapping'
+# Base permanente des equipements
+BPE_DATA_PATH = 'data/open_data/bpe21_ensemble_xy.csv'
+# Processed dataset, partitioned by metropole and property type
+PROCESSED_DATA_PATH = 'data/processed/processed_data'
+PARTITION_COLUMNS = ['LIBEPCI', 'type_local']
+# Types inferred for the object columns holding values of several types (see stringify_mixed)
+MIXED_TYPES = ['mixed', 'mixed-integer']
+# Digests of the files hashed by file_hash, by path, with their size and modification time
+FILE_HASHES_PATH = os.path.join(CACHE_DIR, 'file_hashes.json')
+# Lock of FILE_HASHES_PATH, as files are hashed by the tables loaded in threads
+FILE_HASHES_LOCK = threading.Lock()
+# Files making up a shapefile besides the '.shp' file itself
+SHAPEFILE_EXTENSIONS = ['.shx', '.dbf', '.prj', '.cpg']
+
+# Number of rows parsed at once when streaming DVF files
+DVF_CHUNKSIZE = 500_000
+# Key of the second hash of the row fingerprints (see iter_unique_rows)
+CHECK_HASH_KEY = 'dvf-rows-check16'
+# Multipliers of the splitmix64 finalizer mixing the column hashes of the keyed row hashes
+MIX_MULTIPLIERS = (np.uint64(0xbf58476d1ce4e5b9), np.uint64(0x94d049bb133111eb))
+
+# DVF columns used by the preprocessing pipeline. The duplicated rows are found on all the
+# columns of the files, before the others are dropped (see read_file).
+DVF_COLUMNS = ['id_mutation', 'date_mutation', 'numero_disposition', 'nature_mutation',
+               'valeur_fonciere', 'adresse_numero', 'adresse_suffixe', 'adresse_nom_voie',
+               'adresse_code_voie', 'code_commune', 'nom_commune', 'code_departement',
+               'id_parcelle', 'numero_volume', 'lot1_numero', 'lot1_surface_carrez',
+               'lot2_numero', 'lot2_surface_carrez', 'lot3_numero', 'lot3_surface_carrez',
+               'lot4_numero', 'lot4_surface_carrez', 'lot5_numero', 'lot5_surface_carrez',
+               'nombre_lots', 'type_local', 'surface_reelle_bati', 'nombre_pieces_principales',
+               'nature_culture', 'nature_culture_speciale', 'surface_terrain',
+               'longitude', 'latitude']
+
+# Explicit dtypes of the DVF columns, so that every chunk is parsed the same way
+DVF_DTYPES = {
+    'id_mutation': str, 'date_mutation': str, 'numero_disposition': 'float32',
+    'nature_mutation': 'category', 'valeur_fonciere': 'float64', 'adresse_numero': 'float32',
+    'adresse_suffixe': str, 'adresse_nom_voie': str, 'adresse_code_voie': str,
+    'code_commune': str, 'nom_commune': 'category', 'code_departement': 'category',
+    'id_parcelle': str, 'numero_volume': str,
+    'lot1_numero': str, 'lot1_surface_carrez': 'float32',
+    'lot2_numero': str, 'lot2_surface_carrez': 'float32',
+    'lot3_numero': str, 'lot3_surface_carrez': 'float32',
+    'lot4_numero': str, 'lot4_surface_carrez': 'float32',
+    'lot5_numero': str, 'lot5_surface_carrez': 'float32',
+    'nombre_lots': 'float32', 'type_local': 'category', 'surface_reelle_bati': 'float32',
+    'nombre_pieces_principales': 'float32', 'nature_culture': str,
+    'nature_culture_speciale': str, 'surface_terrain': 'float32',
+    'longitude': 'float64', 'latitude': 'float64'
+}
+
+# Dtype policy applied through the pipeline (see compact_dtypes)
+CATEGORY_COLUMNS = ['nom_commune', 'type_local', 'LIBEPCI', 'code_departement',
+                    'nature_mutation', 'trimestre_vente', 'DCOMIRIS']
+# The prices of the sales ('valeur_fonciere') are kept as float64: float32 rounds them to
+# steps of 0.0625 euros at 1M euros, and of 1 euro at 10M euros
+FLOAT32_COLUMNS = ['surface_reelle_bati', 'surface_terrain',
+                   'lot1_surface_carrez', 'lot2_surface_carrez', 'lot3_surface_carrez',
+                   'lot4_surface_carrez', 'lot5_surface_carrez',
+                   'prix_actualise', 'prix_m2_actualise', 'prix_m2', 'quantile_prix']
+INTEGER_COLUMNS = ['numero_disposition', 'nombre_lots', 'nombre_pieces_principales']
+# Prefix of the prices discounted to several quarters (see discount.fonction_final_prix)
+PRIX_ACTUALISE_PREFIX = 'prix_m2_actualise_'
+
+
+def compact_dtypes(data):
+    """
+    Apply the dtype policy of the pipeline to the columns present in the dataframe: 
+    low-cardinality columns become categoricals, prices and surfaces are stored as float32, 
+    and counts as the smallest integer type (float32 if they have missing values).
+
+    Args:
+        data (pd.DataFrame): The dataframe to convert. It is modified in place.
+
+    Returns:
+        pd.DataFrame: The converted dataframe.
+    """
+    with pd.option_context('mode.chained_assignment', None):
+        for col in data.columns.intersection(CATEGORY_COLUMNS):
+            if not isinstance(data[col].dtype, pd.CategoricalDtype):
+                data[col] = data[col].astype('category')
+        float32_columns = [col for col in data.columns
+                           if col in FLOAT32_COLUMNS or str(col).startswith(PRIX_ACTUALISE_PREFIX)]
+        for col in float32_columns:
+            data[col] = data[col].astype('float32')
+        for col in data.columns.intersection(INTEGER_COLUMNS):
+            values = data[col]
+            if values.notna().all() and (values % 1 == 0).all():
+                data[col] = pd.to_numeric(values.astype('int64'), downcast='integer')
+            else:
+                data[col] = values.astype('float32')
+    return data
+
+
+def concat_frames(frames):
+    """
+    Concatenate dataframes, keeping categorical columns categorical.
+
+    pd.concat turns categoricals into objects when their categories differ from one frame 
+    to another, as happens with chunks read separately. The categories are unified first.
+
+    Args:
+        frames (iterable): The dataframes to concatenate. Their categoricals are modified in place.
+
+    Returns:
+        pd.DataFrame: The concatenated dataframe, with a new index.
+    """
+    frames = list(frames)
+    if len(frames) > 1:
+        with pd.option_context('mode.chained_assignment', None):
+            for col in frames[0].columns:
+                if not all(col in frame and isinstance(frame[col].dtype, pd.CategoricalDtype)
+                           for frame in frames):
+                    continue
+                categories = frames[0][col].cat.categories.append(
+                    [frame[col].cat.categories for frame in frames[1:]]).unique()
+                for frame in frames:
+                    frame[col] = frame[col].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def map_categories(series, func):
+    """
+    Map the values of a series through 'func' by mapping its categories only.
+
+    Args:
+        series (pd.Series): The series to map, converted to a categorical if needed.
+        func (callable): A vectorized function taking and returning a pd.Series of values.
+
+    Returns:
+        pd.Series: The mapped categorical series.
+    """
+    series = series.astype('category')
+    new_codes, new_categories = pd.factorize(func(series.cat.categories.to_series()).to_numpy())
+    codes = series.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, new_codes[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, new_categories),
+                     index=series.index, name=series.name)
+
+
+def get_positions(index, values):
+    """
+    Return the positions of 'values' in 'index' (-1 when missing), looking up 
+    the categories of 'values' only.
+
+    Args:
+        index (pd.Index): The index to look values up in.
+        values (pd.Series): The values, converted to a categorical if needed.
+
+    Returns:
+        np.ndarray: The position of each value.
+    """
+    values = values.astype('category')
+    positions = index.get_indexer(values.cat.categories)
+    codes = values.cat.codes.to_numpy()
+    return np.where(codes >= 0, positions[codes], -1)
+
+
+def mix_hashes(hashes):
+    """
+    Mix the bits of uint64 hashes with the finalizer of splitmix64, a bijection of the 64-bit values.
+    """
+    with np.errstate(over='ignore'):
+        hashes = hashes ^ (hashes >> np.uint64(30))
+        hashes = hashes * MIX_MULTIPLIERS[0]
+        hashes = hashes ^ (hashes >> np.uint64(27))
+        hashes = hashes * MIX_MULTIPLIERS[1]
+        return hashes ^ (hashes >> np.uint64(31))
+
+
+def hash_rows(data, chunksize=DVF_CHUNKSIZE, hash_key=None):
+    """
+    Compute a 64-bit fingerprint of every row of a dataframe, 'chunksize' rows at a time.
+
+    Without key, the rows are hashed by pandas. With a key, each column is hashed by pandas 
+    with that key, which only applies to the strings: the hashes of the numbers do not depend 
+    on it. The hash of each column is thus mixed with a seed derived from the key and the 
+    position of the column, before being chained into the hash of the row, so that the 
+    fingerprints computed with different keys are independent whatever the column types.
+
+    Args:
+        data (pd.DataFrame): The dataframe to hash. Its index is not hashed.
+        chunksize (int, optional): The number of rows hashed at once.
+        hash_key (str, optional): The 16 characters key of the hash. Defaults to the hash of pandas.
+
+    Returns:
+        np.ndarray: The uint64 fingerprint of each row.
+    """
+    if len(data) == 0:
+        return np.empty(0, dtype=np.uint64)
+    if hash_key is None:
+        return np.concatenate([pd.util.hash_pandas_object(data.iloc[start:start + chunksize],
+                                                          index=False).to_numpy()
+                               for start in range(0, len(data), chunksize)])
+
+    seeds = [np.frombuffer(hashlib.blake2b(f"{hash_key}{position}".encode(), digest_size=8).digest(),
+                           dtype=np.uint64)[0] for position in range(data.shape[1])]
+    hashes = np.empty(len(data), dtype=np.uint64)
+    for start in range(0, len(data), chunksize):
+        chunk = data.iloc[start:start + chunksize]
+        chunk_hashes = np.zeros(len(chunk), dtype=np.uint64)
+        for seed, (_, values) in zip(seeds, chunk.items()):
+            column = pd.util.hash_pandas_object(values, index=False, hash_key=hash_key).to_numpy()
+            chunk_hashes = mix_hashes(chunk_hashes ^ mix_hashes(column ^ seed))
+        hashes[start:start + len(chunk)] = chunk_hashes
+    return hashes
+
+
+def duplicated_rows(data, hashes=None):
+    """
+    Mark the rows of a dataframe that duplicate an earlier row, like data.duplicated().
+
+    The rows are compared through their fingerprints. Only the rows sharing their 
+    fingerprint with another row are compared column by column, which also rules out 
+    hash collisions.
+
+    Args:
+        data (pd.DataFrame): The dataframe.
+        hashes (np.ndarray, optional): The fingerprints of the rows, if already computed.
+
+    Returns:
+        np.ndarray: The boolean mask of the duplicated rows.
+    """
+    if hashes is None:
+        hashes = hash_rows(data)
+    duplicated = np.zeros(len(data), dtype=bool)
+    candidates = pd.Series(hashes).duplicated(keep=False).to_numpy()
+    if candidates.any():
+        duplicated[candidates] = data[candidates].duplicated().to_numpy()
+    return duplicated
+
+
+def drop_duplicate_rows(data):
+    """
+    Drop the duplicated rows of a dataframe, keeping the first ones (see duplicated_rows). 
+    Equivalent to data.drop_duplicates() without building the rows of the whole dataframe.
+    """
+    return data[~duplicated_rows(data)]
+
+
+def row_fingerprints(data):
+    """
+    Return the 128-bit fingerprints of the rows of a dataframe, as the hash of pandas and the 
+    hash keyed with CHECK_HASH_KEY of each row (see hash_rows).
+    """
+    return hash_rows(data), hash_rows(data, hash_key=CHECK_HASH_KEY)
+
+
+def match_fingerprints(seen, hashes, checks):
+    """
+    Mark the rows whose fingerprint is one of 'seen'.
+
+    Args:
+        seen (tuple): The first hashes, sorted, and the second hashes of the fingerprints.
+        hashes (np.ndarray): The first hash of each row.
+        checks (np.ndarray): The second hash of each row.
+
+    Returns:
+        np.ndarray: The boolean mask of the rows found in 'seen'.
+    """
+    seen_hashes, seen_checks = seen
+    left = np.searchsorted(seen_hashes, hashes, side='left')
+    right = np.searchsorted(seen_hashes, hashes, side='right')
+    matches = right - left
+    found = np.zeros(len(hashes), dtype=bool)
+    single = np.flatnonzero(matches == 1)
+    found[single] = seen_checks[left[single]] == checks[single]
+    # Several fingerprints with the same first hash, which only happens on collisions
+    for i in np.flatnonzero(matches > 1):
+        found[i] = (seen_checks[left[i]:right[i]] == checks[i]).any()
+    return found
+
+
+def merge_fingerprints(seen, hashes, checks):
+    """
+    Merge fingerprints into the sorted fingerprints 'seen' (see match_fingerprints).
+
+    Returns:
+        tuple: The merged fingerprints.
+    """
+    order = np.argsort(hashes, kind='stable')
+    hashes, checks = hashes[order], checks[order]
+    positions = np.searchsorted(seen[0], hashes, side='right')
+    return np.insert(seen[0], positions, hashes), np.insert(seen[1], positions, checks)
+
+
+def iter_unique_rows(chunks, fingerprints=None):
+    """
+    Drop, chunk by chunk, the rows of a stream of dataframes that duplicate a row of the 
+    same chunk or of an earlier chunk.
+
+    The rows of a chunk are compared to each other exactly (see duplicated_rows). The rows of 
+    earlier chunks are not kept, so a row is not compared to them column by column: it is 
+    dropped when an earlier row has the same 128-bit fingerprint (see row_fingerprints), made 
+    of two hashes which are independent for every column type. Two distinct rows of n get the 
+    same fingerprint with a probability of about n² / 2^129, i.e. 6e-25 for 20 million rows, 
+    which is taken as never happening. The sorted fingerprints of the rows kept so far use 
+    16 bytes per row.
+
+    Args:
+        chunks (iterable): The dataframes, with the same columns.
+        fingerprints (list, optional): If given, the fingerprints of the rows kept are appended 
+        to it, as a (hashes, checks) tuple per chunk, in the order of the rows.
+
+    Yields:
+        pd.DataFrame: The chunks without their duplicated rows.
+    """
+    seen = (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64))
+    for chunk in chunks:
+        hashes, checks = row_fingerprints(chunk)
+        duplicated = duplicated_rows(chunk, hashes)
+        duplicated[~duplicated] = match_fingerprints(seen, hashes[~duplicated], checks[~duplicated])
+
+        hashes, checks = hashes[~duplicated], checks[~duplicated]
+        seen = merge_fingerprints(seen, hashes, checks)
+        if fingerprints is not None:
+            fingerprints.append((hashes, checks))
+        yield chunk[~duplicated]
+
+
+def add_counts(counts, new_counts):
+    """
+    Add row counts to 'counts' in place. The counts are numbers, or pd.Series of the number of 
+    rows of each value of a column, which are added value by value.
+    """
+    for step, rows in new_counts.items():
+        if step not in counts:
+            counts[step] = rows
+        elif isinstance(rows, pd.Series):
+            counts[step] = counts[step].add(rows, fill_value=0).astype('int64')
+        else:
+            counts[step] += rows
+
+
+def count_values(values):
+    """
+    Return the number of rows of each value of a series, indexed by the values themselves 
+    (not by categories), so that the counts of several chunks can be added (see add_counts).
+    """
+    counts = values.value_counts()
+    counts = counts[counts > 0]
+    counts.index = counts.index.astype(object)
+    return counts
+
+
+def iter_data(data_paths, columns=None, dtype=None, chunksize=DVF_CHUNKSIZE, predicate=None,
+              counts=None, count_column=None):
+    """
+    Stream data from the given path(s) as dataframes of at most 'chunksize' rows.
+
+    Args:
+        data_paths: A string or list of strings representing the file path(s) to read data from.
+        columns (list, optional): The columns to read. All columns are read if None.
+        dtype (dict, optional): A mapping of column names to dtypes.
+        chunksize (int, optional): The maximum number of rows of each chunk.
+        predicate (callable, optional): A function returning a boolean mask for a chunk. 
+        Only the rows where the mask is True are kept.
+        counts (dict, optional): If given, the number of rows parsed ('raw') and kept by the 
+        predicate ('selected') are added to it.
+        count_column (str, optional): A column whose values are counted over all the rows parsed, 
+        before the predicate. The counts are added to counts['values'] (see count_values).
+
+    Yields:
+        pd.DataFrame: The successive chunks of the files, read one after another.
+    """
+    if isinstance(data_paths, str):
+        data_paths = [data_paths]
+    if dtype is not None and columns is not None:
+        dtype = {col: dtype[col] for col in columns if col in dtype}
+
+    for path in data_paths:
+        reader = pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunksize)
+        for chunk in reader:
+            chunk_counts = {'raw': len(chunk)}
+            if count_column is not None:
+                chunk_counts['values'] = count_values(chunk[count_column])
+            if predicate is not None:
+                chunk = chunk[predicate(chunk)]
+            chunk_counts['selected'] = len(chunk)
+            if counts is not None:
+                add_counts(counts, chunk_counts)
+            yield chunk
+
+
+def file_dtypes(path, dtype=None):
+    """
+    Return the dtypes to read every column of a csv file with: the given ones, and strings for 
+    the other columns, so that every chunk parses a column the same way.
+    """
+    dtype = dtype or {}
+    return {col: dtype.get(col, str) for col in pd.read_csv(path, nrows=0).columns}
+
+
+def read_file(path, columns=None, dtype=None, chunksize=None, predicate=None, drop_duplicates=False,
+              count_column=None, compact=False, counts=None, fingerprints=None):
+    """
+    Read a single csv file, optionally by chunks (see read_data).
+
+    Args:
+        path (str): The path of the file to read.
+        columns (list, optional): The columns to read. All columns are read if None.
+        dtype (dict, optional): A mapping of column names to dtypes.
+        chunksize (int, optional): If set, the file is parsed by chunks of 'chunksize' rows.
+        predicate (callable, optional): A function returning a boolean mask for a chunk.
+        drop_duplicates (bool, optional): Whether to drop the duplicated rows. The rows are 
+        compared on all the columns of the file, the columns not in 'columns' being parsed as 
+        strings (see file_dtypes) and dropped once the duplicates are found.
+        count_column (str, optional): A column whose values are counted over all the rows parsed 
+        (see iter_data).
+        compact (bool, optional): Whether to apply the dtype policy (see compact_dtypes) to each 
+        chunk kept, before it is held until the concatenation.
+        counts (dict, optional): If given, the number of rows parsed ('raw'), kept by the 
+        predicate ('selected') and left after dropping the duplicates ('deduped') are added to it.
+        fingerprints (list, optional): If given with 'drop_duplicates', the fingerprints of the 
+        rows kept are appended to it (see iter_unique_rows), to find the rows duplicated across 
+        files.
+
+    Returns:
+        pd.DataFrame: The data of the file.
+    """
+    if predicate is not None and not chunksize:
+        raise ValueError("'predicate' can only be applied when reading by chunks.")
+    read_columns = columns
+    if drop_duplicates and columns is not None:
+        read_columns, dtype = None, file_dtypes(path, dtype)
+
+    def project(data):
+        if read_columns is None and columns is not None:
+            return data[[col for col in data.columns if col in columns]]
+        return data
+
+    file_counts = {}
+    if chunksize:
+        chunks = iter_data(path, read_columns, dtype, chunksize, predicate, counts=file_counts,
+                           count_column=count_column)
+        if drop_duplicates:
+            chunks = iter_unique_rows(chunks, fingerprints)
+        chunks = map(project, chunks)
+        if compact:
+            chunks = map(compact_dtypes, chunks)
+        data = concat_frames(chunks)
+    else:
+        if dtype is not None and read_columns is not None:
+            dtype = {col: dtype[col] for col in read_columns if col in dtype}
+        data = pd.read_csv(path, usecols=read_columns, dtype=dtype)
+        file_counts = {'raw': len(data), 'selected': len(data)}
+        if count_column is not None:
+            file_counts['values'] = count_values(data[count_column])
+        if drop_duplicates:
+            data = next(iter_unique_rows([data], fingerprints))
+        data = project(data)
+        if compact:
+            data = compact_dtypes(data)
+    file_counts['deduped'] = len(data)
+
+    if counts is not None:
+        add_counts(counts, file_counts)
+    return data
+
+
+def _read_file_counts(path, *args):
+    """
+    Read a single csv file (see read_file), and return its data with its row counts and the 
+    fingerprints of its rows, if the duplicated rows are dropped.
+    """
+    counts, fingerprints = {}, []
+    data = read_file(path, *args, counts=counts, fingerprints=fingerprints)
+    fingerprints = tuple(np.concatenate(hashes) for hashes in zip(*fingerprints)) if fingerprints \
+        else (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64))
+    return data, counts, fingerprints
+
+
+def read_data(data_paths, columns=None, dtype=None, chunksize=None, predicate=None, n_jobs=1,
+              drop_duplicates=False, count_column=None, compact=False, counts=None):
     """
     Read data from the given path(s) and return a single concatenated dataframe.
 
+    When reading by chunks, the memory used is bounded by the rows kept, not by the size of 
+    the files: at most one raw chunk per file being parsed, plus the rows kept so far. The kept 
+    chunks are concatenated at the end, which copies their numeric and categorical columns and 
+    the pointers of their object columns, but not the strings. The peak memory is thus the kept 
+    rows plus one copy of their column arrays, which is well below twice the kept rows for 
+    DVF data, whose memory mostly goes to strings. With 'compact', the chunks are held and 
+    copied in the compact dtypes. Dropping the duplicates adds 16 bytes per row kept, for their 
+    fingerprints (see iter_unique_rows).
+
     Args:
         data_paths: A string or list of strings representing the file path(s) to read data from.
+        columns (list, optional): The columns to read. All columns are read if None.
+        dtype (dict, optional): A mapping of column names to dtypes.
+        chunksize (int, optional): If set, the files are parsed by chunks of 'chunksize' rows, 
+        so that only the selected columns of the data are held in memory at once.
+        predicate (callable, optional): A function returning a boolean mask for a chunk. Rows 
+        where the mask is False are dropped while the files are parsed. Requires 'chunksize'.
+        n_jobs (int, optional): The number of worker processes parsing the files in parallel 
+        (-1 to use all cores). Each file is parsed by a single worker.
+        drop_duplicates (bool, optional): Whether to drop the duplicated rows. Duplicates are 
+        found on all the columns of the files, chunk by chunk while the files are parsed, before 
+        the columns not in 'columns' are dropped (see read_file and iter_unique_rows).
+        count_column (str, optional): A column whose values are counted over all the rows parsed, 
+        before the predicate and the deduplication. The counts are stored in counts['values'].
+        compact (bool, optional): Whether to apply the dtype policy (see compact_dtypes) to each 
+        chunk kept, as it is read.
+        counts (dict, optional): If given, it is filled with the number of rows parsed ('raw'), 
+        kept by the predicate ('selected') and left after dropping the duplicates ('deduped').
 
     Returns:
         A pandas dataframe consisting of the concatenated data from all the files at the 
-    specified path(s), with a maximum of 1000 rows.
+    specified path(s).
         If an error occurs during the data reading process, None is returned.
     """
     try:
         print('Reading data...')
         # check if input is a single file path or a list of file paths
         if isinstance(data_paths, str):
-            data = pd.read_csv(data_paths)
+            data_paths = [data_paths]
+
+        args = (columns, dtype, chunksize, predicate, drop_duplicates, count_column, compact)
+        if n_jobs == 1 or len(data_paths) == 1:
+            results = [_read_file_counts(path, *args) for path in data_paths]
         else:
-            data = pd.concat(map(pd.read_csv, data_paths))
+            results = Parallel(n_jobs=n_jobs, verbose=1)(
+                delayed(_read_file_counts)(path, *args) for path in data_paths)
+        frames = [frame for frame, _, _ in results]
+
+        if drop_duplicates and len(frames) > 1:
+            # Drop the rows duplicated across files, on the fingerprints of their full rows
+            seen = (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64))
+            for i, (_, _, (hashes, checks)) in enumerate(results):
+                duplicated = match_fingerprints(seen, hashes, checks)
+                seen = merge_fingerprints(seen, hashes[~duplicated], checks[~duplicated])
+                frames[i] = frames[i][~duplicated]
+        data = frames[0] if len(frames) == 1 else concat_frames(frames)
+
+        if counts is not None:
+            for _, file_counts, _ in results:
+                add_counts(counts, file_counts)
+            counts['deduped'] = len(data)
         return data
     except FileNotFoundError as e:
         print(f"Error occurred while reading data: {e}")
@@ -32,6 +566,207 @@ def read_data(data_paths):
         print(f"Error occurred while reading data: {e}")
         return None
 
+
+def read_file_hashes():
+    """
+    Return the digests stored by file_hash, or an empty dict if they cannot be read.
+    """
+    try:
+        with open(FILE_HASHES_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def file_hash(path):
+    """
+    Compute a hash of the content of a file. For a shapefile, the companion files 
+    ('.dbf', '.shx'...) are hashed as well.
+
+    The digests are stored in FILE_HASHES_PATH with the size and modification time of the 
+    files, and only computed again when these change, so that a resumed run does not read 
+    the input files again to find out that they are unchanged.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        str: The hexadecimal digest of the file content.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+    """
+    paths = [path]
+    if path.endswith('.shp'):
+        root = os.path.splitext(path)[0]
+        paths += [root + ext for ext in SHAPEFILE_EXTENSIONS if os.path.exists(root + ext)]
+    stats = [[file_path, stat.st_size, stat.st_mtime_ns] for file_path, stat in
+             zip(paths, map(os.stat, paths))]
+    name = os.path.abspath(path)
+
+    with FILE_HASHES_LOCK:
+        stored = read_file_hashes().get(name)
+    if stored is not None and stored['stats'] == stats:
+        return stored['digest']
+
+    digest = hashlib.blake2b(digest_size=16)
+    for file_path in paths:
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+
+    with FILE_HASHES_LOCK:
+        hashes = read_file_hashes()
+        hashes[name] = {'stats': stats, 'digest': digest.hexdigest()}
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            replace_file(FILE_HASHES_PATH, lambda tmp_path: write_json(hashes, tmp_path))
+        except Exception as e:
+            print(f"Could not store the hash of '{path}': {e}")
+    return digest.hexdigest()
+
+
+def write_json(data, path):
+    """
+    Write data as a JSON file.
+    """
+    with open(path, 'w') as file:
+        json.dump(data, file)
+
+
+def replace_file(path, write):
+    """
+    Write a file through a temporary file next to it, moved in place once complete, so that 
+    an interrupted write never leaves a partial file at 'path'.
+
+    Args:
+        path (str): The path of the file.
+        write (callable): The function writing the file, called with the temporary path.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def stringify_mixed(data):
+    """
+    Convert to strings the values of the object columns holding values of several types 
+    (e.g. commune codes read as numbers and as strings), which parquet cannot store. 
+    Missing values are kept.
+
+    Args:
+        data (pd.DataFrame): The dataframe to convert. It is modified in place.
+
+    Returns:
+        pd.DataFrame: The converted dataframe.
+    """
+    for col in data.columns[data.dtypes == object]:
+        if pd.api.types.infer_dtype(data[col], skipna=True) in MIXED_TYPES:
+            data[col] = data[col].where(data[col].isna(), data[col].astype(str))
+    return data
+
+
+def cached_read(path, reader, **kwargs):
+    """
+    Read a table with the given reader, going through a columnar (parquet) copy of it.
+
+    The copy is stored in CACHE_DIR the first time the file is read, under a name keyed 
+    on the hash of the file and on the reader arguments. Later reads load the copy as long 
+    as the source file is unchanged. A copy that cannot be read is replaced.
+
+    The object columns of mixed types are converted to strings (see stringify_mixed), so 
+    that the table can be stored. The table returned is the same whether it is read from 
+    the source or from the copy.
+
+    Args:
+        path (str): The path of the source file.
+        reader (callable): The function reading the source file, e.g. pd.read_csv.
+        **kwargs: The keyword arguments passed to the reader.
+
+    Returns:
+        pd.DataFrame or gpd.GeoDataFrame: The table read.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update(file_hash(path).encode())
+    key.update(f"{reader.__module__}.{reader.__name__}{sorted(kwargs.items())}".encode())
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(CACHE_DIR, f"{name}-{key.hexdigest()}")
+
+    for extension, read_parquet in [('.geo.parquet', gpd.read_parquet), ('.parquet', pd.read_parquet)]:
+        if os.path.exists(cache_path + extension):
+            try:
+                return read_parquet(cache_path + extension)
+            except Exception as e:
+                print(f"Could not read the cached copy of '{path}', reading it again: {e}")
+
+    data = stringify_mixed(reader(path, **kwargs))
+    cache_path += '.geo.parquet' if isinstance(data, gpd.GeoDataFrame) else '.parquet'
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        replace_file(cache_path, data.to_parquet)
+    except Exception as e:
+        print(f"Could not cache '{path}': {e}")
+    return data
+
+
+def write_processed(data, path=PROCESSED_DATA_PATH):
+    """
+    Write processed data as a parquet dataset partitioned by metropole and property type.
+
+    Each ('LIBEPCI', 'type_local') pair is stored in its own directory, so that the data of 
+    a single metropole and property type can be read without parsing the rest of the data. 
+    The dataset is written to a temporary directory next to 'path', which then replaces any 
+    previous dataset: the previous one is only removed once the new one is complete.
+
+    Args:
+        data (pd.DataFrame): The processed data. A 'geometry' column is dropped, as the points 
+        are given by the 'longitude' and 'latitude' columns.
+        path (str, optional): The directory of the dataset.
+    """
+    data = pd.DataFrame(data).drop(columns=['geometry'], errors='ignore')
+    for col in PARTITION_COLUMNS:
+        data[col] = data[col].astype('category').cat.remove_unused_categories()
+
+    tmp_path, old_path = f"{path}.{os.getpid()}.tmp", f"{path}.{os.getpid()}.old"
+    try:
+        data.to_parquet(tmp_path, partition_cols=PARTITION_COLUMNS, index=False)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Put the previous dataset back
+            if os.path.exists(old_path):
+                os.rename(old_path, path)
+            raise
+    finally:
+        for leftover in [tmp_path, old_path]:
+            if os.path.exists(leftover):
+                shutil.rmtree(leftover)
+
+
+def read_processed(path=PROCESSED_DATA_PATH, columns=None, **partition):
+    """
+    Read processed data written by write_processed.
+
+    Args:
+        path (str, optional): The directory of the dataset.
+        columns (list, optional): The columns to read. All columns are read if None.
+        **partition: Values of the partition columns to read, e.g. 
+        read_processed(LIBEPCI='Métropole de Lyon', type_local='Maison').
+
+    Returns:
+        pd.DataFrame: The processed data of the selected partitions.
+    """
+    filters = [(col, '==', value) for col, value in partition.items()] or None
+    data = pd.read_parquet(path, columns=columns, filters=filters)
+    return compact_dtypes(data)
+
+
 def read_tables(*data_paths):
     """
     Read multiple csv files from the given paths and return a list of dataframes.
@@ -126,12 +861,10 @@ def read_iris():
         FileNotFoundError: If either of the IRIS table files is not found.
         Exception: If an error occurs while reading the tables.
     """
-    iris_value_path = 'data/open_data/IRIS_donnees.csv'
-    iris_shape_path = 'data/open_data/IRIS_contours.shp'
     try:
         print("Reading 'iris' tables...this might take a while")
-        iris_value = pd.read_csv(iris_value_path, delimiter=';')
-        iris_shape = gpd.read_file(iris_shape_path)
+        iris_value = cached_read(IRIS_VALUE_PATH, pd.read_csv, delimiter=';')
+        iris_shape = cached_read(IRIS_SHAPE_PATH, gpd.read_file)
         return iris_value, iris_shape
     except FileNotFoundError as e:
         print(f"Error occurred while reading data: {e}")
@@ -149,11 +882,10 @@ def read_equi():
     Raises:
         IOError: If the amenities file cannot be found or read.
     """
-    bpe_data_path = "data/open_data/bpe21_ensemble_xy.csv"
     try:
         print("Reading 'equipements' table...")
         # Read 'base permanente des equipements' file
-        amenities = pd.read_csv(bpe_data_path, delimiter=';')
+        amenities = cached_read(BPE_DATA_PATH, pd.read_csv, delimiter=';')
         return amenities
     except IOError:
         print("Error: could not read amenities file.")
@@ -185,3 +917,90 @@ def iris_prep(iris_value, iris_shape):
     except Exception as e:
         print(f"Error: {str(e)}")
         return None
+
+
+def unique_coordinates(data):
+    """
+    Find the distinct (longitude, latitude) pairs of a dataframe.
+
+    Args:
+        data (pd.DataFrame): A dataframe with 'longitude' and 'latitude' columns.
+
+    Returns:
+        tuple: A dataframe of the distinct pairs, in order of first appearance, and the position 
+        of the pair of each row in it (-1 for missing coordinates).
+    """
+    coordinates = data[['longitude', 'latitude']]
+    codes = coordinates.groupby(['longitude', 'latitude'], sort=False).ngroup().fillna(-1).to_numpy('int64')
+    unique = coordinates.dropna().drop_duplicates().reset_index(drop=True)
+    return unique, codes
+
+
+def iris_mapping_path(iris_shape_path=IRIS_SHAPE_PATH):
+    """
+    Return the path of the mapping of coordinates to IRIS areas built from the given IRIS contours, 
+    keyed on the hash of the contours so that a new version of them starts a new mapping.
+    """
+    return os.path.join(CACHE_DIR, f"{IRIS_MAPPING_PREFIX}-{file_hash(iris_shape_path)}.parquet")
+
+
+def assign_iris(data, iris_shape, mapping_path=None):
+    """
+    Find the IRIS area (DCOMIRIS) containing each point of a dataframe, as a spatial join with 
+    the 'within' predicate would.
+
+    Only the distinct coordinates are located. Those already in the mapping stored at 'mapping_path' 
+    are read from it, the others are located with a single bulk query of a spatial index of the 
+    IRIS polygons intersecting their bounding box, and added to the mapping (see replace_file).
+
+    Args:
+        data (pd.DataFrame): A dataframe with 'longitude' and 'latitude' columns.
+        iris_shape (gpd.GeoDataFrame): The IRIS polygons, with a 'DCOMIRIS' column.
+        mapping_path (str, optional): The path of the stored mapping (see iris_mapping_path). 
+        Nothing is stored if None.
+
+    Returns:
+        pd.Series: The DCOMIRIS of each row of 'data' (NaN outside of any IRIS area), on its index.
+    """
+    unique, codes = unique_coordinates(data)
+    mapping = pd.DataFrame({'longitude': pd.Series(dtype='float64'),
+                            'latitude': pd.Series(dtype='float64'),
+                            'DCOMIRIS': pd.Series(dtype='object')})
+    if mapping_path is not None and os.path.exists(mapping_path):
+        try:
+            mapping = pd.read_parquet(mapping_path)
+        except Exception as e:
+            # The mapping is only a cache, it is rebuilt from the polygons
+            print(f"Could not read the IRIS mapping, locating all coordinates: {e}")
+
+    unique = unique.merge(mapping, how='left', on=['longitude', 'latitude'], indicator=True)
+    missing = (unique['_merge'] == 'left_only').to_numpy()
+    if missing.any():
+        print(f"Locating {missing.sum()} coordinates in IRIS areas...")
+        lon = unique.loc[missing, 'longitude'].to_numpy('float64')
+        lat = unique.loc[missing, 'latitude'].to_numpy('float64')
+        if iris_shape.crs is not None and iris_shape.crs.is_projected:
+            lon, lat = Transformer.from_crs('EPSG:4326', iris_shape.crs, always_xy=True).transform(lon, lat)
+
+        # Index only the polygons intersecting the bounding box of the points
+        polygons = iris_shape.cx[lon.min():lon.max(), lat.min():lat.max()]
+        tree = shapely.STRtree(np.asarray(polygons.geometry))
+        points, matches = tree.query(shapely.points(lon, lat), predicate='within')
+        # A point lies within a single polygon, as long as the polygons do not overlap
+        points, first = np.unique(points, return_index=True)
+        located = np.full(len(lon), None, dtype=object)
+        located[points] = polygons['DCOMIRIS'].to_numpy()[matches[first]]
+        unique.loc[missing, 'DCOMIRIS'] = located
+
+        if mapping_path is not None:
+            try:
+                os.makedirs(os.path.dirname(mapping_path), exist_ok=True)
+                mapping = pd.concat([mapping, unique.loc[missing, ['longitude', 'latitude', 'DCOMIRIS']]],
+                                    ignore_index=True)
+                replace_file(mapping_path, lambda tmp_path: mapping.to_parquet(tmp_path, index=False))
+            except Exception as e:
+                print(f"Could not store the IRIS mapping: {e}")
+
+    # Rows without coordinates (position -1) point to the last, missing, area
+    dcomiris = np.append(unique['DCOMIRIS'].to_numpy(dtype=object), None)
+    return pd.Series(dcomiris[codes], index=data.index, name='DCOMIRIS')
@@ -0,0 +1,436 @@
+"""
+This module provides functions to checkpoint the stages of a pipeline, so that a run can resume from
+the last stage whose inputs are unchanged, and to report the time, memory and rows used by each stage.
+
+Functions:
+
+    stage_key(parent_key, name, params=None, paths=None): Compute the key of a stage from the key of
+    the stage it follows, its parameters and the files it reads.
+    checkpoint_path(name, key): Return the path of the checkpoint of a stage.
+    has_checkpoint(name, key): Return whether the checkpoint of a stage exists.
+    last_checkpoint(names, keys): Return the position of the last stage whose checkpoint exists.
+    load_checkpoint(name, key, counts=None): Load the output of a stage from its checkpoint.
+    new_report(name, trace_memory=False): Create the report of a run, to be filled by run_stage.
+    start_loads(loaders, max_workers=None): Start loading tables in the background.
+    run_stage(name, key, func, *args, resume=True, report=None, counts=None, inputs=None, **kwargs):
+    Run a stage, or load its output from the checkpoint written by an earlier run with the same key.
+    run_stages(stages, keys, resume=True, report=None): Run the stages of a pipeline in order,
+    loading only the last checkpoint of a resumed run.
+    write_report(report, report_dir=REPORT_DIR): Write the report of a run as a JSON file.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import psutil
+import pandas as pd
+from utils.common import file_hash, replace_file, write_json
+
+
+# Directory of the outputs of the pipeline stages
+CHECKPOINT_DIR = 'data/checkpoints'
+# Version of the format of the checkpoints, part of every key: increase it when the way the
+# outputs or their counts are stored changes
+CHECKPOINT_VERSION = 1
+# Directory of the JSON reports of the runs
+REPORT_DIR = 'output/reports'
+# Interval in seconds between two samples of the resident memory during a stage
+RSS_SAMPLE_INTERVAL = 0.05
+
+MB = 1024 ** 2
+
+
+def stage_key(parent_key, name, params=None, paths=None):
+    """
+    Compute the key of a stage. The keys are chained: a stage is only reused when the stages
+    before it are unchanged as well.
+
+    Args:
+        parent_key (str): The key of the previous stage, or None for the first one.
+        name (str): The name of the stage.
+        params (dict, optional): The parameters of the stage. Their representation is hashed.
+        paths (list, optional): The files read by the stage. Their content is hashed (see file_hash).
+
+    Returns:
+        str: The hexadecimal key of the stage.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update(f"{CHECKPOINT_VERSION}{parent_key}{name}".encode())
+    key.update(repr(sorted((params or {}).items())).encode())
+    for path in paths or []:
+        key.update(file_hash(path).encode())
+    return key.hexdigest()
+
+
+def checkpoint_path(name, key):
+    """
+    Return the path of the checkpoint of a stage, in CHECKPOINT_DIR.
+    """
+    return os.path.join(CHECKPOINT_DIR, f"{name}-{key}.parquet")
+
+
+def has_checkpoint(name, key):
+    """
+    Return whether the checkpoint of a stage exists.
+    """
+    return os.path.exists(checkpoint_path(name, key))
+
+
+def last_checkpoint(names, keys):
+    """
+    Return the position in 'names' of the last stage whose checkpoint exists, or -1 if none does. 
+    A resumed run (see run_stages) starts after it.
+
+    Args:
+        names (list): The names of the stages, in order.
+        keys (dict): The keys of the stages by name. The stages without key have no checkpoint.
+
+    Returns:
+        int: The position of the stage.
+    """
+    for position in reversed(range(len(names))):
+        key = keys.get(names[position])
+        if key is not None and has_checkpoint(names[position], key):
+            return position
+    return -1
+
+
+def counts_path(name, key):
+    """
+    Return the path of the counts stored with the checkpoint of a stage.
+    """
+    return os.path.splitext(checkpoint_path(name, key))[0] + '.json'
+
+
+def read_counts(name, key):
+    """
+    Return the counts stored with the checkpoint of a stage, or None if there are none.
+    """
+    try:
+        with open(counts_path(name, key)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def load_checkpoint(name, key, counts=None):
+    """
+    Load the output of a stage from its checkpoint.
+
+    Args:
+        name (str): The name of the stage.
+        key (str): The key of the stage (see stage_key).
+        counts (dict, optional): If given, it is updated with the counts stored with the checkpoint.
+
+    Returns:
+        pd.DataFrame: The output of the stage, or None if the checkpoint cannot be read.
+    """
+    try:
+        data = pd.read_parquet(checkpoint_path(name, key))
+        if counts is not None and os.path.exists(counts_path(name, key)):
+            with open(counts_path(name, key)) as file:
+                counts.update(json.load(file))
+        return data
+    except Exception as e:
+        print(f"Could not load the checkpoint of stage '{name}': {e}")
+        return None
+
+
+def new_report(name, trace_memory=False):
+    """
+    Create the report of a run. Each stage run with it (see run_stage) adds its metrics to it.
+
+    Args:
+        name (str): The name of the run, used in the name of the report file.
+        trace_memory (bool, optional): Whether to trace the memory allocated by Python during each
+        stage with tracemalloc. Tracing slows the stages down.
+
+    Returns:
+        dict: The report of the run.
+    """
+    return {'run': name, 'started': datetime.now().isoformat(timespec='seconds'),
+            'trace_memory': trace_memory, 'stages': [], '_start': time.perf_counter()}
+
+
+def total_rss(process):
+    """
+    Return the resident memory of a process and of its child processes (e.g. the workers parsing
+    the files) in bytes. The processes which exit meanwhile are left out.
+    """
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def monitor_rss(process, stop, peak, interval=RSS_SAMPLE_INTERVAL):
+    """
+    Sample the resident memory of a process (see total_rss) every 'interval' seconds, and once
+    more when 'stop' is set, keeping the highest sample in peak['rss']. Meant to be run in a
+    thread during a stage.
+    """
+    while True:
+        stopped = stop.wait(interval)
+        peak['rss'] = max(peak['rss'], total_rss(process))
+        if stopped:
+            break
+
+
+def frame_memory_mb(data):
+    """
+    Return the memory used by a dataframe in MB, including the content of its object columns.
+    """
+    return round(data.memory_usage(deep=True).sum() / MB, 1)
+
+
+def start_loads(loaders, max_workers=None):
+    """
+    Start loading tables in a pool of threads, so that the reads of the tables which do not
+    depend on the output of a stage overlap with the stages run in the meantime.
+
+    Threads are used rather than processes so that the tables are not pickled back, which would
+    cost about as much as reading them. Most of the reads (pyarrow for the parquet copies of
+    CACHE_DIR, GDAL, the csv parser) release the GIL.
+
+    Args:
+        loaders (dict): The functions loading the tables, called without arguments, by name.
+        max_workers (int, optional): The number of threads. Defaults to one per table.
+
+    Returns:
+        dict: The futures of the tables, by name.
+    """
+    if not loaders:
+        return {}
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(loaders))
+    futures = {name: executor.submit(loader) for name, loader in loaders.items()}
+    # The loads submitted go on, the threads exit once they are done
+    executor.shutdown(wait=False)
+    return futures
+
+
+def measure_stage(name, call, report=None, checkpoint=False, rows_in=None, counts=None):
+    """
+    Call a stage and, when a report is given, add the metrics of the call to it (see run_stage). 
+    Nothing is added if the stage returns None.
+
+    Args:
+        name (str): The name of the stage.
+        call (callable): The stage, called without arguments.
+        report (dict, optional): The report of the run (see new_report).
+        checkpoint (bool, optional): Whether the stage is loaded from its checkpoint.
+        rows_in (int, optional): The number of rows of the input of the stage. Defaults to
+        counts['raw'], the number of rows parsed by a stage reading files.
+        counts (dict, optional): The number of rows left after each step of the stage.
+
+    Returns:
+        pd.DataFrame: The output of the stage.
+    """
+    process = psutil.Process()
+    trace = report is not None and report['trace_memory']
+    if trace:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    rss = process.memory_info().rss
+    peak = {'rss': total_rss(process)}
+    stop = threading.Event()
+    monitor = threading.Thread(target=monitor_rss, args=(process, stop, peak), daemon=True)
+    monitor.start()
+    try:
+        data = call()
+        traced = tracemalloc.get_traced_memory() if trace else None
+    finally:
+        stop.set()
+        monitor.join()
+        if trace:
+            tracemalloc.stop()
+
+    if report is not None and data is not None:
+        report['stages'].append({
+            'stage': name,
+            'checkpoint': checkpoint,
+            'skipped': False,
+            'wall_time_s': round(time.perf_counter() - wall, 3),
+            'cpu_time_s': round(time.process_time() - cpu, 3),
+            'rss_mb': round(process.memory_info().rss / MB, 1),
+            'rss_delta_mb': round((process.memory_info().rss - rss) / MB, 1),
+            'peak_rss_mb': round(peak['rss'] / MB, 1),
+            'traced_delta_mb': round(traced[0] / MB, 1) if traced else None,
+            'traced_peak_mb': round(traced[1] / MB, 1) if traced else None,
+            'rows_in': rows_in if rows_in is not None else (counts or {}).get('raw'),
+            'rows_out': len(data),
+            'memory_out_mb': frame_memory_mb(data),
+            'counts': counts,
+        })
+    return data
+
+
+def load_stage(name, key, report=None, counts=None):
+    """
+    Load the output of a stage from its checkpoint (see load_checkpoint), adding the metrics of 
+    the load to the report.
+
+    Returns:
+        pd.DataFrame: The output of the stage, or None if the checkpoint cannot be read.
+    """
+    print(f"Loading stage '{name}' from checkpoint...")
+    return measure_stage(name, lambda: load_checkpoint(name, key, counts), report=report,
+                         checkpoint=True, counts=counts)
+
+
+def run_stage(name, key, func, *args, resume=True, report=None, counts=None, inputs=None, **kwargs):
+    """
+    Run a stage of a pipeline, or load its output from the checkpoint written by an earlier run
+    with the same key.
+
+    The output is written as a parquet file, which keeps the column types (categories,
+    downcast numbers...). It is written to a temporary file moved in place (see replace_file),
+    after its counts, so that an interrupted run never leaves a partial checkpoint. If it cannot
+    be written, the run goes on without checkpoint; if it cannot be read, the stage is run again.
+
+    When a report is given, the following metrics of the stage are added to it: wall and CPU time
+    (the time of worker processes is not included), resident memory after the stage and its
+    change, highest resident memory during the stage, including the worker processes (sampled
+    every RSS_SAMPLE_INTERVAL seconds, so shorter peaks may be missed), memory traced by
+    tracemalloc (if enabled in the report), number of rows of the first argument (or parsed by
+    the stage, see measure_stage) and of the output, and memory of the output. The time and memory
+    of the tables loaded in the background meanwhile (see start_loads) are counted as well.
+
+    Args:
+        name (str): The name of the stage.
+        key (str): The key of the stage (see stage_key), or None to run the stage without
+        checkpoint.
+        func (callable): The function of the stage, returning a dataframe.
+        *args: The positional arguments of 'func'.
+        resume (bool, optional): Whether to load the checkpoint of the stage when it exists.
+        report (dict, optional): The report of the run (see new_report).
+        counts (dict, optional): If given, it is passed to 'func' as its 'counts' argument, to be
+        filled with the number of rows left after each of its steps. The counts are stored with
+        the checkpoint, so that they are reported when the stage is loaded from it.
+        inputs (dict, optional): The futures of the tables read by the stage (see start_loads), by
+        argument name. They are only waited for when the stage is run, and passed to 'func' as
+        keyword arguments. A missing future (None) is passed as None.
+        **kwargs: The keyword arguments of 'func'.
+
+    Returns:
+        pd.DataFrame: The output of the stage.
+
+    Raises:
+        ValueError: If the stage fails and returns None.
+    """
+    if resume and key is not None and has_checkpoint(name, key):
+        data = load_stage(name, key, report, counts)
+        if data is not None:
+            return data
+        print(f"Running stage '{name}' instead...")
+
+    if counts is not None:
+        kwargs['counts'] = counts
+
+    def call():
+        for arg, future in (inputs or {}).items():
+            kwargs[arg] = future.result() if future is not None else None
+        return func(*args, **kwargs)
+
+    rows_in = len(args[0]) if args and isinstance(args[0], pd.DataFrame) else None
+    data = measure_stage(name, call, report=report, rows_in=rows_in, counts=counts)
+    if data is None:
+        raise ValueError(f"Stage '{name}' failed.")
+
+    if key is None:
+        return data
+    try:
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        # The counts are written first: the checkpoint only exists once both are complete
+        if counts is not None:
+            replace_file(counts_path(name, key), lambda tmp_path: write_json(counts, tmp_path))
+        replace_file(checkpoint_path(name, key), pd.DataFrame(data).to_parquet)
+    except Exception as e:
+        print(f"Could not write the checkpoint of stage '{name}': {e}")
+    return data
+
+
+def run_stages(stages, keys, resume=True, report=None):
+    """
+    Run the stages of a pipeline in order, each on the output of the previous one.
+
+    When resuming, only the checkpoint of the last stage whose checkpoint exists (see 
+    last_checkpoint) is loaded, and the stages after it are run: the stages before it are 
+    skipped, without loading their output. Their counts are still read from their checkpoints 
+    for the report. If the checkpoint cannot be read, the previous one is tried.
+
+    Args:
+        stages (list): The stages, as (name, func, args, kwargs) tuples. 'func' is called with 
+        the output of the previous stage (except for the first stage) followed by 'args', and 
+        'kwargs' are passed to run_stage (e.g. 'counts', 'inputs').
+        keys (dict): The keys of the stages by name (see stage_key). The stages whose key is 
+        None are run without checkpoint.
+        resume (bool, optional): Whether to resume from the checkpoints.
+        report (dict, optional): The report of the run (see new_report).
+
+    Returns:
+        pd.DataFrame: The output of the last stage.
+
+    Raises:
+        ValueError: If a stage fails and returns None.
+    """
+    names = [stage[0] for stage in stages]
+    data = None
+    first_entry = len(report['stages']) if report is not None else 0
+    position = last_checkpoint(names, keys) if resume else -1
+    while position >= 0:
+        name, _, _, kwargs = stages[position]
+        data = load_stage(name, keys[name], report, kwargs.get('counts'))
+        if data is not None:
+            break
+        position = last_checkpoint(names[:position], keys)
+
+    if report is not None and position > 0:
+        report['stages'][first_entry:first_entry] = [
+            {'stage': name, 'checkpoint': True, 'skipped': True, 'counts': read_counts(name, keys[name])}
+            for name in names[:position]]
+
+    for position in range(position + 1, len(stages)):
+        name, func, args, kwargs = stages[position]
+        if position > 0:
+            args = (data, *args)
+        data = run_stage(name, keys.get(name), func, *args, resume=False, report=report, **kwargs)
+    return data
+
+
+def write_report(report, report_dir=REPORT_DIR):
+    """
+    Write the report of a run as a JSON file in 'report_dir', named after the run and its start.
+
+    Besides the metrics of each stage, the report holds the total wall time of the run and its
+    funnel: the number of rows left after each step of the stages, in order.
+
+    Args:
+        report (dict): The report of the run (see new_report).
+        report_dir (str, optional): The directory of the report.
+
+    Returns:
+        str: The path of the report, or None if it could not be written.
+    """
+    output = {k: v for k, v in report.items() if not k.startswith('_')}
+    output['wall_time_s'] = round(time.perf_counter() - report['_start'], 3)
+    output['funnel'] = {}
+    for stage in report['stages']:
+        for step, rows in (stage['counts'] or {}).items():
+            output['funnel'][f"{stage['stage']}.{step}"] = rows
+
+    path = os.path.join(report_dir, f"{report['run']}-{report['started'].replace(':', '')}.json")
+    try:
+        os.makedirs(report_dir, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(output, file, indent=2)
+        return path
+    except Exception as e:
+        print(f"Could not write the report of the run: {e}")
+        return None
@@ -0,0 +1,7 @@
+"""
+Configuration of the tests: the modules of 'src' are imported as the scripts import them.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
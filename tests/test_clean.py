@@ -0,0 +1,59 @@
+"""
+Tests of data_processing.clean.
+"""
+import numpy as np
+import pandas as pd
+from data_processing.clean import clean_multivente
+
+
+def baseline_clean_type(data, type_bien):
+    """The original cleaning of a property type, grouping on the 'index_group' strings."""
+    clean_data = data[data['type_local'] == type_bien]
+    new_data = clean_data.groupby('index_group')['numero_disposition'].nunique()
+    new_data = clean_data[clean_data.index_group.isin(new_data[new_data == 1].index)]\
+                .groupby('index_group').size()
+    to_drop = new_data[new_data > 1].index
+    return clean_data.drop(clean_data[clean_data.index_group.isin(to_drop)].index)
+
+
+def baseline_clean_multivente(data):
+    """The original multivente cleaning, with a groupby per step and per property type."""
+    data = data.drop_duplicates()
+    data = data[data['nature_mutation'] == 'Vente'].copy()
+    data['index_group'] = data['id_mutation'].astype(str) + data['date_mutation'].astype(str)
+    new_data = data.groupby('index_group')['numero_disposition'].nunique()
+    to_drop = new_data[new_data > 1].index
+    data = data.drop(data[data.index_group.isin(to_drop)].index)
+    clean_data = pd.concat([baseline_clean_type(data, 'Appartement'), baseline_clean_type(data, 'Maison')])
+    return clean_data.drop(columns='index_group')
+
+
+def make_mutations(nb_rows=4000, seed=0):
+    """Mutations of a few rows each, mixing types, dispositions and duplicated rows."""
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        'id_mutation': [f'2021-{i:04d}' for i in rng.integers(0, nb_rows // 3, nb_rows)],
+        'date_mutation': rng.choice(['2021-01-04', '2021-06-30'], nb_rows),
+        'numero_disposition': rng.choice([1, 1, 1, 2, np.nan], nb_rows),
+        'nature_mutation': rng.choice(['Vente', 'Vente', 'Echange'], nb_rows),
+        'type_local': rng.choice(['Maison', 'Appartement', 'Dépendance', None], nb_rows),
+        'valeur_fonciere': rng.choice([150000.0, 230000.0], nb_rows),
+    })
+    return pd.concat([data, data.sample(300, random_state=seed)], ignore_index=True)
+
+
+def test_clean_multivente_matches_baseline():
+    data = make_mutations()
+    expected = baseline_clean_multivente(data)
+    result = clean_multivente(data)
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_clean_multivente_on_deduplicated_data():
+    data = make_mutations(seed=1)
+    expected = baseline_clean_multivente(data)
+    result = clean_multivente(data.drop_duplicates(), drop_duplicates=False)
+
+    pd.testing.assert_frame_equal(result, expected)
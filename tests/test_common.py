@@ -0,0 +1,98 @@
+"""
+Tests of utils.common.
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+from utils.common import (assign_iris, CHECK_HASH_KEY, drop_duplicate_rows, hash_rows, iter_unique_rows,
+                          read_data)
+
+
+def make_rows(nb_rows=3000, seed=0):
+    """Rows drawn from few values, so that many of them are duplicated within and across chunks."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'id_mutation': rng.choice(['2021-1', '2021-2', '2021-3', None], nb_rows),
+        'valeur_fonciere': rng.choice([150000.0, 1000000.05, 1000000.1, np.nan], nb_rows),
+        'nombre_lots': rng.integers(0, 3, nb_rows),
+        'type_local': pd.Categorical(rng.choice(['Maison', 'Appartement'], nb_rows)),
+    })
+
+
+def test_iter_unique_rows_matches_drop_duplicates():
+    data = make_rows()
+    chunks = [data.iloc[start:start + 500].copy() for start in range(0, len(data), 500)]
+    # Chunks read separately have their own categories
+    for chunk in chunks[1::2]:
+        chunk['type_local'] = chunk['type_local'].cat.reorder_categories(['Maison', 'Appartement'])
+    unique = pd.concat(list(iter_unique_rows(chunks)))
+
+    expected = data.drop_duplicates()
+    assert unique.index.tolist() == expected.index.tolist()
+
+
+def test_drop_duplicate_rows_matches_drop_duplicates():
+    data = make_rows(seed=1)
+    assert drop_duplicate_rows(data).index.tolist() == data.drop_duplicates().index.tolist()
+
+
+def test_keyed_hash_of_numeric_rows_is_independent():
+    data = make_rows(seed=2)[['valeur_fonciere', 'nombre_lots']].drop_duplicates()
+    hashes = hash_rows(data)
+    checks = hash_rows(data, hash_key=CHECK_HASH_KEY)
+    other_checks = hash_rows(data, hash_key='another-key-16ch')
+
+    assert not (hashes == checks).any()
+    assert not (checks == other_checks).any()
+    # The hashes are the same whatever the number of rows hashed at once
+    assert (hash_rows(data, chunksize=3, hash_key=CHECK_HASH_KEY) == checks).all()
+
+
+def test_read_data_drops_duplicates_on_full_rows(tmp_path):
+    data = make_rows(seed=3)
+    # A column which is not read, but tells apart rows that are otherwise the same
+    data['code_postal'] = np.random.default_rng(3).choice(['69001', '69002'], len(data))
+    paths = [str(tmp_path / 'a.csv'), str(tmp_path / 'b.csv')]
+    data.iloc[:1500].to_csv(paths[0], index=False)
+    data.iloc[1500:].to_csv(paths[1], index=False)
+    columns = ['id_mutation', 'valeur_fonciere', 'nombre_lots', 'type_local']
+
+    expected = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True).drop_duplicates()
+    for chunksize in (200, None):
+        result = read_data(paths, columns=columns, dtype={'valeur_fonciere': 'float64'},
+                           chunksize=chunksize, drop_duplicates=True)
+        assert result.columns.tolist() == columns
+        assert len(result) == len(expected)
+        assert (result['valeur_fonciere'].fillna(-1).to_numpy()
+                == expected['valeur_fonciere'].fillna(-1).to_numpy()).all()
+
+
+def make_iris():
+    """A grid of square IRIS areas, and points inside, outside of and without coordinates."""
+    iris_shape = gpd.GeoDataFrame(
+        {'DCOMIRIS': [f'69123{i:04d}' for i in range(16)]},
+        geometry=[box(4.8 + 0.05 * (i % 4), 45.7 + 0.05 * (i // 4), 4.85 + 0.05 * (i % 4), 45.75 + 0.05 * (i // 4))
+                  for i in range(16)],
+        crs='EPSG:4326')
+    rng = np.random.default_rng(0)
+    location = rng.integers(0, 200, 1000)
+    lon, lat = rng.uniform(4.79, 5.01, 200), rng.uniform(45.69, 45.91, 200)
+    data = pd.DataFrame({'longitude': lon[location], 'latitude': lat[location]}, index=rng.permutation(1000))
+    data.iloc[:10] = np.nan
+    return data, iris_shape
+
+
+def test_assign_iris_matches_spatial_join(tmp_path):
+    data, iris_shape = make_iris()
+    points = gpd.GeoDataFrame(data, geometry=gpd.points_from_xy(data['longitude'], data['latitude']),
+                              crs='EPSG:4326')
+    expected = points.sjoin(iris_shape, how='left', predicate='within')['DCOMIRIS']
+
+    mapping_path = str(tmp_path / 'iris_mapping.parquet')
+    for _ in range(2):
+        # The second call reads the locations from the stored mapping
+        result = assign_iris(data, iris_shape, mapping_path)
+        assert result.index.equals(data.index)
+        assert result.notna().sum() > 500
+        assert result.fillna('').tolist() == expected.fillna('').tolist()
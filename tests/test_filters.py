@@ -0,0 +1,96 @@
+"""
+Tests of data_processing.filters.
+"""
+import numpy as np
+import pandas as pd
+from data_processing.filters import filtre_dur, filtre_prix, merge_sketches, quantile_sketch, PRIX_BIN_WIDTH
+
+
+def baseline_filtre_dur(df, bati, piece, local, metropole_name=None):
+    """The original filter of a single property type, concatenating the filtered and other rows."""
+    if metropole_name:
+        df_metropole = df[(df['type_local'] == local) & (df['LIBEPCI'] == metropole_name)]
+        df_other_metropoles = df[(df['LIBEPCI'] != metropole_name)
+                                 | ((df['LIBEPCI'] == metropole_name) & (df['type_local'] != local))]
+    else:
+        df_metropole = df[df['type_local'] == local]
+        df_other_metropoles = df[df['type_local'] != local]
+    df_metropole = df_metropole[(df_metropole['surface_reelle_bati'] <= bati)
+                                & (df_metropole['nombre_pieces_principales'] <= piece)]
+    return pd.concat([df_metropole, df_other_metropoles])
+
+
+def baseline_filtre_prix(df, metric_prix, quantile_nv=0.99):
+    """The original price filter, with a groupby of np.quantile merged back on the rows."""
+    df = df[(df[metric_prix] >= 1000) & (df[metric_prix] <= 20000)]
+    quantile_per_city_type = (
+            df.groupby(['nom_commune', 'type_local'], observed=True)
+            .agg({metric_prix: lambda x: np.quantile(x, quantile_nv)})
+            .reset_index()
+            .rename(columns={metric_prix: 'quantile_prix'})
+        )
+    df = df.merge(quantile_per_city_type, on=['nom_commune', 'type_local'], how='left')
+    return df[df[metric_prix] < df['quantile_prix']]
+
+
+def make_properties(nb_rows=5000, seed=0):
+    """Properties of several types, metropoles and cities, with prices partly out of range."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'type_local': pd.Categorical(rng.choice(['Maison', 'Appartement', 'Local'], nb_rows)),
+        'LIBEPCI': rng.choice(['Métropole de Lyon', 'Métropole du Grand Paris'], nb_rows),
+        'nom_commune': pd.Categorical(rng.choice(['Lyon', 'Paris', 'Bron', 'Vanves'], nb_rows)),
+        'surface_reelle_bati': rng.integers(10, 500, nb_rows).astype('float32'),
+        'nombre_pieces_principales': rng.integers(0, 14, nb_rows).astype('float32'),
+        'prix_m2': rng.uniform(500, 22000, nb_rows),
+    }, index=rng.permutation(nb_rows))
+
+
+def test_filtre_dur_matches_baseline():
+    df = make_properties()
+    seuils = {'Maison': (360, 10), 'Appartement': (200, 6)}
+    expected = df
+    for local, (bati, piece) in seuils.items():
+        expected = baseline_filtre_dur(expected, bati, piece, local)
+
+    result = filtre_dur(df, seuils)
+    # The rows keep their order, while the baseline moved the filtered type first
+    assert result.index.tolist() == df.index[df.index.isin(expected.index)].tolist()
+    pd.testing.assert_frame_equal(result, expected.loc[result.index])
+
+
+def test_filtre_dur_metropole_override():
+    df = make_properties(seed=1)
+    expected = baseline_filtre_dur(df, 200, 6, 'Appartement')
+    expected = baseline_filtre_dur(expected, 150, 5, 'Appartement', 'Métropole du Grand Paris')
+
+    result = filtre_dur(df, {'Appartement': (200, 6), ('Métropole du Grand Paris', 'Appartement'): (150, 5)})
+    assert sorted(result.index) == sorted(expected.index)
+    # The former signature is still accepted
+    result = filtre_dur(df, 150, 5, 'Appartement', 'Métropole du Grand Paris')
+    expected = baseline_filtre_dur(df, 150, 5, 'Appartement', 'Métropole du Grand Paris')
+    assert sorted(result.index) == sorted(expected.index)
+
+
+def test_filtre_prix_matches_baseline():
+    df = make_properties(seed=2)
+    expected = baseline_filtre_prix(df, 'prix_m2')
+    result = filtre_prix(df, 'prix_m2')
+
+    assert len(result) == len(expected) > 0
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_filtre_prix_sketch_of_chunks():
+    df = make_properties(seed=3)
+    expected = baseline_filtre_prix(df, 'prix_m2')
+    sketch = merge_sketches(quantile_sketch(df.iloc[start:start + 1000], 'prix_m2')
+                            for start in range(0, len(df), 1000))
+    result = filtre_prix(df, 'prix_m2', sketch=sketch)
+
+    # The approximate quantiles are within a bin of the exact ones
+    groups = ['nom_commune', 'type_local']
+    merged = result.drop_duplicates(groups).merge(expected.drop_duplicates(groups), on=groups,
+                                                  suffixes=('', '_exact'))
+    assert len(merged) == 12
+    assert (merged['quantile_prix'] - merged['quantile_prix_exact']).abs().max() < PRIX_BIN_WIDTH
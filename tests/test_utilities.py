@@ -0,0 +1,121 @@
+"""
+Tests of data_processing.utilities.
+"""
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LinearRegression
+from data_processing.utilities import (alter_metric_name, apply_linear_regression, calculate_closest_metric,
+                                       calculate_neighbor_features, compute_by_location, get_nearest_neighbors,
+                                       get_top_zones, REGRESSION_FEATURES)
+
+
+def baseline_top_zones(df, nb_top_zones, metropoles):
+    """The original selection of the top metropoles, merging on the commune names as strings."""
+    df = df.astype({'nom_commune': object})
+    for city in ['Marseille', 'Lyon', 'Paris']:
+        df.loc[df['nom_commune'].str.startswith(city + ' ', na=False), 'nom_commune'] = city
+    df = df.merge(metropoles, how='left', left_on='nom_commune', right_on='LIBGEO')
+    most_frequent = df['LIBEPCI'].value_counts().head(nb_top_zones).index.to_list()
+    return df.loc[df['LIBEPCI'].isin(most_frequent)]
+
+
+def make_data():
+    """DVF rows with a sale without commune, and metropoles with communes missing from DVF."""
+    communes = ['Lyon 1er Arrondissement', 'Lyon 2e Arrondissement', 'Villeurbanne', 'Lyon 3e Arrondissement',
+                'Marseille 1er Arrondissement', 'Marseille 8e Arrondissement', 'Paris 5e Arrondissement',
+                None, 'Hors metropole']
+    df = pd.DataFrame({'id_mutation': [f'm{i}' for i in range(len(communes))],
+                       'nom_commune': pd.Categorical(communes)})
+    metropoles = pd.DataFrame({
+        'LIBGEO': ['Lyon', 'Villeurbanne', 'Bron', 'Marseille', 'Aubagne', 'Paris', 'Boulogne-Billancourt'],
+        'LIBEPCI': ['Métropole de Lyon', 'Métropole de Lyon', 'Métropole de Lyon', "Métropole d'Aix-Marseille",
+                    "Métropole d'Aix-Marseille", 'Métropole du Grand Paris', 'Métropole du Grand Paris']})
+    return df, metropoles
+
+
+def test_get_top_zones_matches_baseline():
+    df, metropoles = make_data()
+    expected = baseline_top_zones(df, 2, metropoles)
+    result = get_top_zones(df.copy(), 2, metropoles.copy())
+
+    assert len(result) == len(expected) == 6
+    assert result['nom_commune'].notna().all()
+    assert result['id_mutation'].tolist() == expected['id_mutation'].tolist()
+    assert result['LIBEPCI'].astype(object).tolist() == expected['LIBEPCI'].tolist()
+
+
+def test_get_top_zones_ranks_on_counts():
+    df, metropoles = make_data()
+    # The ranking counts every transaction, while df only holds part of them: Paris ranks 
+    # first on the counts although it has a single row in df
+    commune_counts = pd.Series([5, 2, 1, 7, 3], index=pd.Index(['Lyon 1er Arrondissement', 'Villeurbanne',
+                                                                 'Marseille 1er Arrondissement',
+                                                                 'Paris 5e Arrondissement', np.nan],
+                                                                dtype=object))
+    result = get_top_zones(df.copy(), 2, metropoles.copy(), commune_counts)
+
+    assert set(result['LIBEPCI']) == {'Métropole de Lyon', 'Métropole du Grand Paris'}
+    assert result['id_mutation'].tolist() == ['m0', 'm1', 'm2', 'm3', 'm6']
+
+
+def make_locations(nb_locations=300, nb_rows=1000, seed=0):
+    """Rows of properties sharing few locations, with columns that only depend on the location."""
+    rng = np.random.default_rng(seed)
+    lon, lat = rng.uniform(4.7, 5.0, nb_locations), rng.uniform(45.6, 45.9, nb_locations)
+    location = rng.integers(0, nb_locations, nb_rows)
+    income = np.where(rng.random(nb_locations) < 0.3, np.nan, rng.uniform(10000, 40000, nb_locations))
+    amenity = np.where(rng.random(nb_locations) < 0.5, np.nan, rng.integers(0, 5, nb_locations))
+    return pd.DataFrame({
+        'longitude': lon[location], 'latitude': lat[location],
+        'DISP_MED19': income[location], 'DISP_Q119': income[location] * 0.6,
+        'A203': amenity[location],
+        'surface_reelle_bati': rng.integers(20, 200, nb_rows).astype('float64'),
+        'nombre_pieces_principales': rng.integers(1, 8, nb_rows).astype('float64'),
+        'prix_m2': rng.uniform(2000, 8000, nb_rows),
+    })
+
+
+def baseline_alter_metric_name(df, input_variable_names, output_variable_names):
+    """The original filling of each variable, with a nearest neighbour query of every row."""
+    new_metrics = {}
+    for input_var, output_var in zip(input_variable_names, output_variable_names):
+        table_info = df[df[input_var].notnull()]
+        indices = get_nearest_neighbors(left_gdf=df, right_gdf=table_info, k_neighbors=1)[:, 0]
+        new_metrics[output_var] = table_info[input_var].to_numpy()[indices]
+    return df.assign(**new_metrics).drop(columns=input_variable_names)
+
+
+def test_alter_metric_name_matches_baseline():
+    df = make_locations()
+    inputs, outputs = ['DISP_MED19', 'DISP_Q119', 'A203'], ['Mediane', 'Q1', 'Banques']
+    expected = baseline_alter_metric_name(df, inputs, outputs)
+    result = alter_metric_name(df, inputs, outputs)
+
+    assert result[outputs].notna().all().all()
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_apply_linear_regression_matches_sklearn():
+    table_info = make_locations(seed=1)
+    indices = np.random.default_rng(1).integers(0, len(table_info), (50, 10))
+    intercepts, slopes = apply_linear_regression(table_info, indices, 'prix_m2', return_slopes=True)
+
+    for row, neighbors in enumerate(indices):
+        lr = LinearRegression().fit(table_info.loc[neighbors, REGRESSION_FEATURES].to_numpy(),
+                                    table_info.loc[neighbors, 'prix_m2'].to_numpy())
+        assert np.isclose(intercepts[row], lr.intercept_)
+        assert np.allclose(slopes[row], lr.coef_)
+
+
+def test_compute_by_location_matches_all_rows():
+    df = make_locations(seed=2)
+    table_info = make_locations(nb_locations=500, nb_rows=500, seed=3)
+    expected = calculate_neighbor_features(df.copy(), table_info, [(3, 'prix_m2', 'mean'), (5, 'prix_m2', 'median')])
+    result = compute_by_location(df.copy(), calculate_neighbor_features, table_info=table_info,
+                                 specs=[(3, 'prix_m2', 'mean'), (5, 'prix_m2', 'median')])
+    pd.testing.assert_frame_equal(result, expected)
+
+    expected = calculate_closest_metric(df.copy(), table_info, 3, 'prix_m2', 'moyenne')
+    result = compute_by_location(df.copy(), calculate_closest_metric, table_info=table_info, k_neighbors=3,
+                                 metric_of_interest='prix_m2', new_metric_name='moyenne')
+    pd.testing.assert_frame_equal(result, expected)